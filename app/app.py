@@ -1,69 +1,287 @@
+import asyncio
+from anyio import CapacityLimiter, to_thread
 from tempfile import gettempdir
-from fastapi import FastAPI, Request, HTTPException, File, UploadFile, status
-from fastapi.responses import RedirectResponse,JSONResponse,FileResponse,StreamingResponse,PlainTextResponse
+from io import BytesIO
+from fastapi import FastAPI, Request, HTTPException, File, UploadFile, Body, Query, status
+from fastapi.responses import RedirectResponse,JSONResponse,FileResponse,StreamingResponse,PlainTextResponse,Response
 from uuid_utils import uuid7
 from uuid import UUID, uuid4
 from tiniestarchive import FileArchive,FileInstance,FileResource
+from tiniestarchive import profiling, scheduling
+from tiniestarchive.utils import chunker
 
 from typing import List
-from os import getenv,walk,listdir,makedirs
+from os import cpu_count,getenv,walk,listdir,makedirs
 from os.path import exists,join,dirname
 import logging
 from json import dumps,loads
+from itertools import islice
+from mimetypes import guess_type
 
 ARCHIVE_DIR=getenv('DATA_DIR', '/data')
 LOG_LEVEL=getenv('LOG_LEVEL', 'WARNING')
 PREFIX=getenv('PREFIX', None)
+STAGING_DIR=getenv('STAGING_DIR', None)
+DURABILITY=getenv('DURABILITY', None)
+CATALOG=getenv('CATALOG', '').lower() in [ 'true', '1', 'yes' ] or None
+PROFILE=getenv('PROFILE', '').lower() in [ 'true', '1', 'yes' ]
+PROFILE_THRESHOLD=float(getenv('PROFILE_THRESHOLD')) if getenv('PROFILE_THRESHOLD') else None
+PROFILE_SIZE=int(getenv('PROFILE_SIZE', 100))
+IO_LIMITS=loads(getenv('IO_LIMITS', 'null'))
+MAX_CHUNK_SIZE=int(getenv('MAX_CHUNK_SIZE', 64*1024*1024))
 logging.basicConfig(level=LOG_LEVEL)
 
 app = FastAPI(root_path=PREFIX)
-archive = FileArchive(ARCHIVE_DIR)
+archive = FileArchive(ARCHIVE_DIR, staging=STAGING_DIR, durability=DURABILITY, catalog=CATALOG)
+
+if IO_LIMITS:
+    # e.g {"maintenance": {"rate": 52428800, "concurrency": 1}}
+    scheduling.configure(IO_LIMITS)
+
+# Ingest and maintenance requests wait for a slot of their class in the
+# event loop and run on threads of their own, so that however many of them
+# are queued or throttled, the thread pool is left to foreground requests
+LIMITERS = { x:CapacityLimiter((IO_LIMITS or {}).get(x, {}).get('concurrency', None) or 40) for x in [ scheduling.INGEST, scheduling.MAINTENANCE ] }
+
+async def _run(io_class, f, *args):
+    return await to_thread.run_sync(f, *args, limiter=LIMITERS[io_class])
+
+if PROFILE or PROFILE_THRESHOLD is not None:
+    # only installed when asked for, so that it costs nothing otherwise
+    profiler = profiling.enable(size=PROFILE_SIZE, threshold=PROFILE_THRESHOLD)
+
+    @app.middleware('http')
+    async def profile_request(request: Request, call_next):
+        # the archive operations of the request are captured, in the thread
+        # that runs them, rather than the request as a whole
+        header = request.headers.get('x-profile', '').lower()
+
+        if not header:
+            return await call_next(request)
+
+        with profiler.request(f'{request.method} {request.url.path}', memory='memory' in header):
+            return await call_next(request)
 
 @app.get("/")
 async def root():
     return archive.config
 
 @app.get("/{resource_id}/", response_class=JSONResponse)
-async def get_resource(resource_id : UUID):
-    return archive.get(str(resource_id)).json()
+async def get_resource(request: Request, resource_id : UUID, fields : str = None, cursor : str = None, limit : int = None):
+    if not archive.exists(str(resource_id)):
+        raise HTTPException(status_code=404, detail='Resource not found')
+
+    # answer conditional requests without loading the resource
+    etag = f'"{archive.version(str(resource_id))}"'
+
+    if etag in [ x.strip().removeprefix('W/') for x in request.headers.get('if-none-match', '').split(',') ]:
+        return Response(status_code=304, headers={ 'ETag': etag })
+
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail=f'Invalid limit: {limit}')
+
+    manifest = archive.get(str(resource_id)).manifest(
+                    fields=fields.split(',') if fields else None,
+                    cursor=cursor,
+                    limit=limit)
+
+    return JSONResponse(manifest, headers={ 'ETag': f'"{manifest["version"]}"' })
 
 @app.post("/{resource_id}/_add")
-async def add(resource_id : UUID, files: List[UploadFile]):
-    with archive.get(resource_id, mode='w') as r:
+def add(resource_id : UUID, files: List[UploadFile]):
+    # writers take the resource lock, so in the thread pool rather than
+    # holding up the event loop
+    with archive.get(str(resource_id), mode='w') as r:
         with r.transaction() as t:
             for file in files:
                 t.add(file.filename, data=file.file)
 
     return "OK"
 
+@app.post("/{resource_id}/_uploads")
+async def create_upload(resource_id : UUID, path : str = Body(), size : int = Body(), checksum : str = Body(None)):
+    try:
+        return archive.upload(str(resource_id), path, size, checksum=checksum).json()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/{resource_id}/_uploads/{session_id}")
+async def get_upload(resource_id : UUID, session_id : UUID):
+    return _upload(resource_id, session_id).json()
+
+@app.put("/{resource_id}/_uploads/{session_id}")
+async def put_chunk(request: Request, resource_id : UUID, session_id : UUID, offset : int):
+    session = _upload(resource_id, session_id)
+
+    if not request.headers.get('x-checksum', None):
+        raise HTTPException(status_code=400, detail='Missing X-Checksum header')
+
+    # chunks are kept in memory rather than written to disk twice, so they
+    # are bounded to MAX_CHUNK_SIZE
+    if int(request.headers.get('content-length', 0)) > MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f'Chunks are limited to {MAX_CHUNK_SIZE} bytes')
+
+    body = bytearray()
+    async for b in request.stream():
+        body += b
+
+        if len(body) > MAX_CHUNK_SIZE:
+            raise HTTPException(status_code=413, detail=f'Chunks are limited to {MAX_CHUNK_SIZE} bytes')
+
+    try:
+        return await asyncio.to_thread(session.write, offset, BytesIO(body), checksum=request.headers['x-checksum'])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/{resource_id}/_uploads/{session_id}/_commit")
+def commit_upload(resource_id : UUID, session_id : UUID):
+    session = _upload(resource_id, session_id)
+
+    if not session.complete():
+        raise HTTPException(status_code=409, detail=f"Upload is incomplete: {session.ranges()}")
+
+    try:
+        with archive.get(str(resource_id), mode='w') as r:
+            session.commit(r)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return "OK"
+
+@app.delete("/{resource_id}/_uploads/{session_id}")
+async def abort_upload(resource_id : UUID, session_id : UUID):
+    _upload(resource_id, session_id).abort()
+
+    return "OK"
+
+def _upload(resource_id : UUID, session_id : UUID):
+    try:
+        session = archive.get_upload(str(session_id))
+    except Exception:
+        raise HTTPException(status_code=404, detail='Upload session not found')
+
+    if session.config['resource'] != str(resource_id):
+        raise HTTPException(status_code=404, detail='Upload session not found')
+
+    return session
+
+@app.post("/{resource_id}/_have")
+async def have(resource_id : UUID, files : List[dict] = Body()):
+    # which of the files, by checksum and size, need not be uploaded
+    return archive.get(str(resource_id)).have(files)
+
 @app.post("/{resource_id}/_update")
 async def ingest(resource_id : UUID, file: UploadFile):
-    with FileInstance.deserialize(file.file) as instance:
+    # the instance is sent by the client, e.g its paths are checked before
+    # anything is written
+    def update():
+        with FileInstance.deserialize(file.file, staging=archive.staging) as instance:
             with archive.get(str(resource_id), mode='w') as r:
+                r.complete(instance)
                 r.update(instance)
 
+    try:
+        await _run(scheduling.INGEST, update)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     return "OK"
 
 @app.get("/{resource_id}/_serialize", response_class=StreamingResponse)
-async def stream(resource_id : UUID):
-    headers = { 'Content-Disposition': f'attachment; filename="{resource_id}.tar"' }
+async def stream(resource_id : UUID, instance_id : UUID = None):
+    # the whole resource, or a single instance
+    headers = { 'Content-Disposition': f'attachment; filename="{instance_id or resource_id}.tar"' }
 
     return StreamingResponse(
-            archive.get(str(resource_id)).serialize(as_iter=True),
+            archive.get(str(resource_id)).serialize(as_iter=True, instance_id=str(instance_id) if instance_id else None),
             headers=headers,
             media_type='application/tar')
 
-@app.get("/{resource_id}/{filename}", response_class=FileResponse)
-async def get_file(resource_id : UUID, filename: str):
-    return FileResponse(archive._resolve(resource_id, filename))
+@app.get("/{resource_id}/{filename:path}", response_class=FileResponse)
+async def get_file(request: Request, resource_id : UUID, filename: str):
+    resource = archive.get(str(resource_id))
+
+    if not resource.exists(filename):
+        raise HTTPException(status_code=404, detail='File not found')
+
+    if 'range' in request.headers:
+        return _ranged(resource, filename, request.headers['range'])
+
+    # serve stored gzip bytes as-is when the client accepts them
+    encoding = resource.encoding(filename)
+    precompressed = encoding == 'gzip' and _accepts(request.headers.get('accept-encoding', ''), 'gzip')
+    headers = { 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding' } if precompressed else { 'Vary': 'Accept-Encoding' } if encoding else {}
+
+    if not resource.packed(filename) and (not encoding or precompressed):
+        return FileResponse(resource._resolve(filename), media_type=guess_type(filename)[0], headers=headers)
+
+    return StreamingResponse(
+            chunker(resource.open_stored(filename) if precompressed else resource.open(filename, mode='rb')),
+            media_type=guess_type(filename)[0],
+            headers=headers)
+
+def _accepts(header, coding):
+    # q-values of the codings, an explicit coding takes precedence over '*'
+    q = {}
+    for x in header.split(','):
+        name, *params = [ y.strip() for y in x.split(';') ]
+
+        try:
+            q[name.lower()] = next((float(y[2:]) for y in params if y.lower().startswith('q=')), 1.0)
+        except ValueError:
+            q[name.lower()] = 0.0
+
+    return q.get(coding, q.get('*', 0.0)) > 0
+
+def _ranged(resource, filename, header):
+    # a single byte range, of the original content, for resumed downloads
+    size = resource._entry(filename)['size']
+
+    try:
+        start, end = header.strip().removeprefix('bytes=').split('-')
+        start, end = (int(start), min(int(end or size - 1), size - 1)) if start else (max(0, size - int(end)), size - 1)
+    except ValueError:
+        raise HTTPException(status_code=416, detail='Invalid range')
+
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, headers={ 'Content-Range': f'bytes */{size}' })
+
+    def i():
+        with resource.open(filename, mode='rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+
+            while remaining > 0 and (b := f.read(min(remaining, 1024*1024))):
+                remaining -= len(b)
+                yield b
+
+    return StreamingResponse(
+            i(),
+            status_code=206,
+            media_type=guess_type(filename)[0],
+            headers={ 'Content-Range': f'bytes {start}-{end}/{size}', 'Content-Length': str(end - start + 1), 'Accept-Ranges': 'bytes' })
 
 @app.post("/_ingest")
 async def ingest(file: UploadFile):
-    with FileResource.deserialize(file.file) as resource:
-        archive.ingest(resource)
+    # the tarball may contain any number of serialized resources
+    def ingest():
+        for resource in FileResource.deserialize_many(file.file, staging=archive.staging):
+            with resource:
+                archive.ingest(resource)
+
+    try:
+        await _run(scheduling.INGEST, ingest)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     return "OK"
 
+@app.post("/_read", response_class=StreamingResponse)
+async def read_many(items: List[List[str]]):
+    return StreamingResponse(
+            archive.serialize_many(items, as_iter=True),
+            media_type='application/tar')
+
 @app.get("/_resources", response_class=PlainTextResponse)
 async def resources(request: Request):
     # TODO implement paging
@@ -71,18 +289,111 @@ async def resources(request: Request):
         for r in archive:
             yield r + '\n'
 
-    return StreamingResponse(i, media_type='text/plain')
+    return StreamingResponse(i(), media_type='text/plain')
+
+@app.get("/_scan")
+async def scan(fields : str = None, workers : int = None):
+    # every worker is a process, so at most one per cpu
+    if workers is not None and workers < 1:
+        raise HTTPException(status_code=400, detail=f'Invalid workers: {workers}')
+
+    workers = min(workers or 1, cpu_count() or 1)
+    manifests = archive.scan(workers=workers, fields=fields.split(',') if fields else None)
+
+    async def i():
+        while (manifest := await _run(scheduling.MAINTENANCE, next, manifests, None)) is not None:
+            yield dumps(manifest) + '\n'
+
+    return StreamingResponse(i(), media_type='text/jsonl')
 
 @app.get("/_events", response_class=JSONResponse)
-async def events(request: Request):
-    start = request.query_params.get('start', None)
-    max = request.query_params.get('max', None)
+async def events(request : Request, start : str = None, position : int = 0, max : int = None, listen : bool = False):
+    if listen:
+        # Server-Sent Events with the position as id, so that reconnecting
+        # clients resume from Last-Event-ID
+        position = int(request.headers.get('last-event-id', position))
 
-    return StreamingResponse(
-            archive.events(
-                start=start,
-                max=max),
-            media_type='text/jsonl')
+        return StreamingResponse(_listen(request, start, position, max), media_type='text/event-stream', headers={ 'Cache-Control': 'no-cache' })
+
+    def i():
+        for event in islice(archive.events(start=start, position=position), max):
+            yield dumps(event) + '\n'
+
+    return StreamingResponse(i(), media_type='text/jsonl')
+
+async def _listen(request : Request, start : str, position : int, max : int = None):
+    # every subscriber waits on its own asyncio.Event, set by the shared
+    # reader of the event log
+    stream = archive.event_stream()
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    callback = lambda: loop.call_soon_threadsafe(wake.set)
+    n = 0
+
+    stream.subscribe(callback)
+
+    try:
+        while not await request.is_disconnected():
+            wake.clear()
+            events, position = await asyncio.to_thread(stream.read, position, start)
+
+            for event in events:
+                yield f"id: {event['position']}\ndata: {dumps(event)}\n\n"
+                n += 1
+
+                if max and n >= max:
+                    return
+
+            if events or stream.position > position:
+                continue
+
+            try:
+                await asyncio.wait_for(wake.wait(), 15)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+    finally:
+        stream.unsubscribe(callback)
+
+@app.get("/_find")
+async def find(checksum : str):
+    return _catalog(lambda: archive.find(checksum))
+
+@app.get("/_changed")
+async def changed(since : str, path : str = None):
+    # epoch or ISO 8601
+    try:
+        return _catalog(lambda: archive.changed(since, path=path))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'Invalid timestamp: {since}')
+
+@app.get("/_usage")
+async def usage(resource_id : List[UUID] = Query(None)):
+    return _catalog(lambda: archive.usage([ str(x) for x in resource_id ] if resource_id else None))
+
+def _catalog(f):
+    if not archive.catalog:
+        raise HTTPException(status_code=404, detail='Catalog is not enabled')
+
+    return f()
+
+@app.get("/_profiles")
+async def profiles():
+    return _profiler().list()
+
+@app.get("/_profile")
+async def profile(id : str, file : str):
+    try:
+        data = _profiler().get(id)['files'][file]
+    except Exception:
+        raise HTTPException(status_code=404, detail='Profile not found')
+
+    return Response(data, media_type='text/plain' if file.endswith('.txt') else 'application/octet-stream', headers={ 'Content-Disposition': f'attachment; filename="{id}-{file}"' })
+
+def _profiler():
+    if not profiling.profiler:
+        raise HTTPException(status_code=404, detail='Profiling is not enabled')
+
+    return profiling.profiler
 
 @app.get('/ok')
 async def ok():
@@ -0,0 +1,58 @@
+import importlib.util
+import socket
+from pathlib import Path
+from threading import Thread
+from time import sleep
+from uuid import uuid4
+
+import pytest
+
+from tiniestarchive import scheduling
+
+APP = Path(__file__).parent.parent.joinpath('app', 'app.py')
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    # a fresh app module, configured through the environment as the app is
+    def load(**env):
+        monkeypatch.setenv('DATA_DIR', str(tmp_path.joinpath('archive')))
+
+        for k, v in env.items():
+            monkeypatch.setenv(k, v)
+
+        spec = importlib.util.spec_from_file_location(f'app_{uuid4().hex}', APP)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        return module
+
+    yield load
+
+    # IO_LIMITS configure the scheduler of the whole process
+    scheduling.configure(None)
+
+@pytest.fixture
+def serve():
+    # runs an ASGI app with uvicorn, for clients that need a real server
+    import uvicorn
+
+    servers = []
+
+    def start(app) -> str:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+        Thread(target=server.run, daemon=True).start()
+        servers.append(server)
+
+        while not server.started:
+            sleep(0.01)
+
+        return f'http://127.0.0.1:{port}/'
+
+    yield start
+
+    for server in servers:
+        server.should_exit = True
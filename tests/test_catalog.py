@@ -0,0 +1,68 @@
+from io import BytesIO
+from json import loads
+
+from tiniestarchive import FileArchive
+
+def add(archive, data : bytes) -> str:
+    with archive.new() as r:
+        with r.transaction() as t:
+            t.add(None, path='a', data=BytesIO(data))
+
+    return r.resource_id
+
+def checksum(archive, resource_id : str) -> str:
+    return archive.get(resource_id)._entry('a')['checksum']
+
+def test_enabled_catalog_is_recorded(tmp_path):
+    archive = FileArchive(tmp_path, operation_mode='dynamic')
+    resource_id = add(archive, b'a')
+
+    archive = FileArchive(tmp_path, catalog=True)
+
+    assert archive.find(checksum(archive, resource_id)) == [ { 'resource': resource_id, 'path': 'a' } ]
+    assert loads(tmp_path.joinpath('config.json').read_text())['catalog'] is True
+    assert FileArchive(tmp_path).catalog
+
+def test_catalog_catches_up_with_writers_without_it(tmp_path):
+    archive = FileArchive(tmp_path, operation_mode='dynamic', catalog=True)
+    other = FileArchive(tmp_path, catalog=False)
+
+    # interleaved with a writer that keeps the catalog up to date
+    deleted = add(archive, b'deleted')
+    added = add(other, b'added')
+    other.delete(deleted)
+    kept = add(archive, b'kept')
+
+    assert archive.catalog.position() < archive.logger.position()
+    assert not archive.find(checksum(archive, added))
+
+    archive = FileArchive(tmp_path)
+
+    assert archive.catalog.position() == archive.logger.position()
+    assert set(archive.usage()) == { added, kept }
+    assert archive.find(checksum(archive, added)) == [ { 'resource': added, 'path': 'a' } ]
+
+def test_catalog_position_follows_writers(tmp_path):
+    archive = FileArchive(tmp_path, operation_mode='dynamic', catalog=True)
+    resource_id = add(archive, b'a')
+
+    with archive.get(resource_id, mode='w') as r:
+        with r.transaction() as t:
+            t.add(None, path='b', data=BytesIO(b'b'))
+
+    archive.compact(resource_id)
+    archive.delete(add(archive, b'c'))
+
+    assert archive.catalog.position() == archive.logger.position()
+
+def test_missing_catalog_is_rebuilt(tmp_path):
+    archive = FileArchive(tmp_path, catalog=True)
+    resource_id = add(archive, b'a')
+    del archive
+
+    for x in tmp_path.glob('catalog.sqlite*'):
+        x.unlink()
+
+    archive = FileArchive(tmp_path)
+
+    assert archive.find(checksum(archive, resource_id)) == [ { 'resource': resource_id, 'path': 'a' } ]
@@ -0,0 +1,27 @@
+import pytest
+
+from tiniestarchive import FileArchive
+from tiniestarchive.__main__ import main
+
+def test_commands_need_an_existing_archive(tmp_path):
+    for argv in [ [ 'ls', str(tmp_path.joinpath('typo')) ], [ 'verify', str(tmp_path.joinpath('typo')), '--workers', '1' ] ]:
+        with pytest.raises(SystemExit):
+            main(argv)
+
+    assert not tmp_path.joinpath('typo').exists()
+
+def test_shards_need_an_archive_path(tmp_path):
+    for argv in [ [ 'import', 'http://127.0.0.1:1/', str(tmp_path) ], [ 'export', 'http://127.0.0.1:1/', str(tmp_path), '--shard-size', '10M' ] ]:
+        with pytest.raises(SystemExit):
+            main(argv)
+
+def test_ingest_and_verify(tmp_path):
+    tmp_path.joinpath('dir').mkdir()
+    tmp_path.joinpath('dir', 'a').write_text('a')
+
+    assert main([ 'ingest', str(tmp_path.joinpath('archive')), str(tmp_path.joinpath('dir')), '--workers', '2' ]) == 0
+    assert main([ 'verify', str(tmp_path.joinpath('archive')), '--workers', '2' ]) == 0
+
+    archive = FileArchive(tmp_path.joinpath('archive'))
+
+    assert [ archive.get(x).read('a') for x in archive ] == [ 'a' ]
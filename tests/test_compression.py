@@ -0,0 +1,11 @@
+from tiniestarchive import FileArchive
+
+from test_replication import add
+
+def test_suffixes_match_any_case(tmp_path):
+    archive = FileArchive(tmp_path.joinpath('archive'), compression={ 'method': 'gzip', 'suffixes': [ '.TXT' ] })
+    resource_id = add(archive, **{ 'a.txt': 'a', 'b.Txt': 'b', 'c.xml': 'c' })
+    r = archive.get(resource_id)
+
+    assert [ r._entry(x).get('encoding', None) for x in [ 'a.txt', 'b.Txt', 'c.xml' ] ] == [ 'gzip', 'gzip', None ]
+    assert r.read('a.txt') == 'a'
@@ -0,0 +1,47 @@
+from io import BytesIO
+
+from tiniestarchive import FileArchive, FileResource
+from tiniestarchive.filetable import FileTable
+
+def entry(path, **kwargs):
+    return { 'id': '01a151b9-afc8-7361-a892-665ebaf7e9d4', 'path': path, 'size': 1, 'checksum': 'md5:' + 16 * 'ab', **kwargs }
+
+def test_optional_column_on_earlier_row():
+    # the first optional value goes to a row other than the last, so the
+    # column has to cover the rows after it too
+    table = FileTable()
+    table.update('i1', [ entry('a'), entry('b'), entry('c') ])
+    table.update('i2', [ entry('a', encoding='gzip', stored_size=2, stored_checksum='md5:' + 32 * '1') ])
+
+    assert table.entry('a')['encoding'] == 'gzip'
+    assert table.entry('a')['stored_checksum'] == 'md5:' + 32 * '1'
+
+    for path in [ 'b', 'c' ]:
+        assert table.entry(path) == entry(path)
+
+    table.update('i3', [ entry('d'), entry('e', pack='packs/00000.pack', offset=0) ])
+
+    assert table.entry('d') == entry('d')
+    assert table['e'] == 'instances/i3/packs/00000.pack'
+    assert table['c'] == 'instances/i1/data/c'
+
+def test_compression_enabled_after_ingest(tmp_path):
+    archive = FileArchive(tmp_path.joinpath('archive'), operation_mode='dynamic')
+    resource = FileResource(staging=archive.staging)
+
+    with resource.transaction() as t:
+        for name in [ 'a', 'b', 'c' ]:
+            t.add(None, path=f'{name}.txt', data=BytesIO(name.encode('utf-8') * 10))
+
+    archive.ingest(resource)
+
+    archive = FileArchive(tmp_path.joinpath('archive'), compression={ 'method': 'gzip' })
+    with archive.get(resource.resource_id, mode='w').transaction() as t:
+        t.add(None, path='a.txt', data=BytesIO(b'new'))
+
+    r = archive.get(resource.resource_id)
+
+    assert r.read('a.txt') == 'new'
+    assert r.read('b.txt') == 'b' * 10
+    assert 'encoding' not in r.files.entry('c.txt')
+    assert 'stored_checksum' not in r.files.entry('b.txt')
@@ -0,0 +1,64 @@
+from io import BytesIO
+from uuid import uuid4
+
+from fastapi.testclient import TestClient
+
+from tiniestarchive import FileInstance
+
+from test_ingest import tarball
+
+def instance_with(files : dict, exclude : list) -> BytesIO:
+    # a serialized instance, as HttpResource.update sends it, with entries
+    # that are listed but left out
+    instance = FileInstance(mode='w')
+    instance.add(None, path='b.txt', data=BytesIO(b'b'))
+    instance.config['files'].update(files)
+    instance._save()
+
+    return BytesIO(instance.serialize(exclude=exclude).read())
+
+def test_update_completes_left_out_files(load_app):
+    app = load_app()
+    client = TestClient(app.app)
+
+    with app.archive.new() as r:
+        with r.transaction() as t:
+            t.add(None, path='a.txt', data=BytesIO(b'secret'))
+
+    entry = app.archive.get(r.resource_id)._entry('a.txt')
+    tarball = instance_with({ 'c.txt': { **entry, 'path': 'c.txt' } }, [ 'c.txt' ])
+
+    assert client.post(f'/{r.resource_id}/_update', files={ 'file': tarball }).status_code == 200
+    assert app.archive.get(r.resource_id).read('c.txt') == 'secret'
+
+def test_update_rejects_paths_outside_the_resource(load_app, tmp_path):
+    app = load_app()
+    client = TestClient(app.app)
+
+    with app.archive.new() as r:
+        with r.transaction() as t:
+            t.add(None, path='a.txt', data=BytesIO(b'secret'))
+
+    entry = app.archive.get(r.resource_id)._entry('a.txt')
+    version = app.archive.version(r.resource_id)
+
+    for path in [ '../' * 20 + str(tmp_path.joinpath('x').relative_to('/')), 'd/../../x', '/x' ]:
+        tarball = instance_with({ path: { **entry, 'path': path } }, [ path ])
+
+        assert client.post(f'/{r.resource_id}/_update', files={ 'file': tarball }).status_code == 400
+
+    assert not tmp_path.joinpath('x').exists()
+    assert app.archive.version(r.resource_id) == version
+
+def test_update_rejects_invalid_tarballs(load_app, tmp_path):
+    app = load_app()
+    client = TestClient(app.app)
+
+    with app.archive.new() as r:
+        pass
+
+    for names in [ [ 'x/instance.json' ], [ f'{uuid4()}/../../../x' ], [ '../' * 20 + str(tmp_path.joinpath('x').relative_to('/')) ] ]:
+        assert client.post(f'/{r.resource_id}/_update', files={ 'file': tarball(*names) }).status_code == 400
+
+    assert not tmp_path.joinpath('x').exists()
+    assert not tmp_path.joinpath('archive', 'x').exists()
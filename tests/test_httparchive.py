@@ -0,0 +1,13 @@
+from tiniestarchive import HttpResource
+
+from test_replication import add
+
+def test_only_first_manifest_pages_are_cached(load_app, serve):
+    app = load_app()
+    url = serve(app.app)
+    resource_id = add(app.archive, **{ f'{i:03}': str(i) for i in range(50) })
+    r = HttpResource(f'{url}{resource_id}/', page_size=5)
+
+    assert len(r.files) == 50
+    assert len(r.files) == 50
+    assert len(r._manifests) == 2
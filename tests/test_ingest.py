@@ -0,0 +1,50 @@
+import tarfile
+from io import BytesIO
+from uuid import uuid4
+
+from fastapi.testclient import TestClient
+
+from tiniestarchive import FileResource
+
+def test_no_lock_files_left_in_staging(load_app, tmp_path):
+    app = load_app()
+    client = TestClient(app.app)
+
+    resource = FileResource(staging=tmp_path.joinpath('client'))
+    with resource.transaction() as t:
+        t.add(None, path='a', data=BytesIO(b'a'))
+
+    assert client.post('/_ingest', files={ 'file': BytesIO(resource.serialize().read()) }).status_code == 200
+
+    with app.archive.new() as r:
+        with r.transaction() as t:
+            t.add(None, path='a', data=BytesIO(b'a'))
+
+    assert app.archive.get(resource.resource_id).read('a') == 'a'
+    assert not list(app.archive.staging.rglob('*.lock'))
+    assert not list(tmp_path.joinpath('client').rglob('*.lock'))
+
+def tarball(*names) -> BytesIO:
+    b = BytesIO()
+    with tarfile.open(fileobj=b, mode='w') as t:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = 1
+            t.addfile(info, BytesIO(b'x'))
+
+    b.seek(0)
+
+    return b
+
+def test_ingest_rejects_invalid_tarballs(load_app, tmp_path):
+    app = load_app()
+    client = TestClient(app.app)
+    resource_id = str(uuid4())
+    app.archive.staging.joinpath(resource_id).mkdir(parents=True)
+
+    for names in [ [ 'x/resource.json' ], [ f'{uuid4()}/../../../x' ], [ '../' * 20 + str(tmp_path.joinpath('x').relative_to('/')) ], [ f'{resource_id}/resource.json' ] ]:
+        assert client.post('/_ingest', files={ 'file': tarball(*names) }).status_code == 400
+
+    assert not tmp_path.joinpath('x').exists()
+    assert not tmp_path.joinpath('archive', 'x').exists()
+    assert list(app.archive.staging.joinpath(resource_id).iterdir()) == []
@@ -0,0 +1,39 @@
+from io import BytesIO
+from time import sleep
+
+from tiniestarchive import FileArchive, FileResource, HttpArchive
+from tiniestarchive.multiarchive import MultiArchive
+
+def test_tier_over_http_archive(load_app, serve, tmp_path):
+    app = load_app()
+
+    with app.archive.new() as r:
+        with r.transaction() as t:
+            t.add(None, path='a', data=BytesIO(b'a' * 1000))
+
+    tier = FileArchive(tmp_path.joinpath('tier'), operation_mode='dynamic')
+    archive = MultiArchive([ tier, HttpArchive(serve(app.app)) ], capacity=[ 10000, None ], promote_after=2)
+
+    for _ in range(2):
+        assert archive.get(r.resource_id).read('a', mode='rb') == b'a' * 1000
+
+    for _ in range(100):
+        if tier.exists(r.resource_id):
+            break
+
+        sleep(0.05)
+
+    assert isinstance(archive.get(r.resource_id).resources[0], FileResource)
+    assert archive.tiers()[0] == { 'capacity': 10000, 'used': 1000, 'resources': 1 }
+
+    # a copy that is out of date is never read
+    with app.archive.get(r.resource_id, mode='w') as x:
+        with x.transaction() as t:
+            t.add(None, path='a', data=BytesIO(b'b'))
+
+    assert archive.get(r.resource_id).read('a', mode='rb') == b'b'
+    assert not tier.exists(r.resource_id)
+    assert archive.tiers()[0]['resources'] == 0
+    assert not [ x for x in tier.root_dir.rglob('*.lock') if r.resource_id in x.name ]
+
+    archive.close()
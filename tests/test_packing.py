@@ -0,0 +1,28 @@
+from io import BytesIO
+
+from tiniestarchive import FileArchive, FileInstance
+
+from test_replication import add
+
+def test_merge_packed_instance_into_open_instance(tmp_path):
+    source = FileArchive(tmp_path.joinpath('source'), operation_mode='preservation', packing={ 'threshold': 1024 })
+    target = FileArchive(tmp_path.joinpath('target'), operation_mode='dynamic')
+
+    resource_id = add(source, **{ 'a.txt': 'a', 'b.txt': 'b' })
+    instance = source.get(resource_id).get_instance(source.get(resource_id).last_instance())
+
+    assert all('pack' in instance[x] for x in instance)
+
+    # transactions are merged into an open last instance
+    target_id = add(target, **{ 'a.txt': 'x', 'c.txt': 'c' })
+    path = target.get(target_id).path.joinpath('instances', target.get(target_id).last_instance(), 'instance.json')
+    path.write_text(path.read_text().replace('"finalized"', '"open"'))
+
+    with target.get(target_id, mode='w') as r:
+        r.update(FileInstance.deserialize(BytesIO(instance.serialize().read()), staging=target.staging))
+
+    r = target.get(target_id)
+
+    assert len(r.instances) == 1
+    assert [ r.read(x) for x in [ 'a.txt', 'b.txt', 'c.txt' ] ] == [ 'a', 'b', 'c' ]
+    assert not any('pack' in r._entry(x) for x in [ 'a.txt', 'b.txt' ])
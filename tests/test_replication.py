@@ -0,0 +1,95 @@
+from io import BytesIO
+from uuid import uuid4
+
+from tiniestarchive import FileArchive, HttpArchive
+from tiniestarchive.replication import Replicator
+
+def add(archive, resource_id : str = None, **files) -> str:
+    if resource_id is None:
+        with archive.new() as r:
+            with r.transaction() as t:
+                for path, data in files.items():
+                    t.add(None, path=path, data=BytesIO(data.encode('utf-8')))
+
+        return r.resource_id
+
+    with archive.get(resource_id, mode='w') as r:
+        with r.transaction() as t:
+            for path, data in files.items():
+                t.add(None, path=path, data=BytesIO(data.encode('utf-8')))
+
+    return resource_id
+
+def test_replicate_from_http_archive(load_app, serve, tmp_path):
+    app = load_app()
+    source = HttpArchive(serve(app.app))
+    resource_id = add(app.archive, a='a')
+
+    assert source.exists(resource_id)
+    assert not source.exists(str(uuid4()))
+    assert source.read(resource_id, 'a', mode='rb') == b'a'
+
+    target = FileArchive(tmp_path.joinpath('target'))
+    replicator = Replicator(source, target)
+
+    assert replicator.run() == 1
+    assert target.get(resource_id).read('a') == 'a'
+
+    add(app.archive, resource_id, b='b')
+
+    assert replicator.run() == 1
+    assert target.get(resource_id).read('b') == 'b'
+    assert target.get(resource_id).config['instances'] == app.archive.get(resource_id).config['instances']
+
+def test_replicate_compaction(tmp_path):
+    for mode in [ 'dynamic', 'preservation' ]:
+        source = FileArchive(tmp_path.joinpath(mode, 'source'), operation_mode=mode)
+        target = FileArchive(tmp_path.joinpath(mode, 'target'), operation_mode=mode)
+        replicator = Replicator(source, target)
+
+        resource_id = add(source, a='a')
+        add(source, resource_id, b='b')
+        replicator.run()
+
+        source.compact(resource_id)
+        replicator.run()
+
+        assert list(target.get(resource_id).instances) == list(source.get(resource_id).instances)
+        assert target.get(resource_id).read('a') == 'a'
+        assert target.get(resource_id).read('b') == 'b'
+
+def test_replicate_changes_to_open_instances(tmp_path):
+    source = FileArchive(tmp_path.joinpath('source'), operation_mode='dynamic')
+    target = FileArchive(tmp_path.joinpath('target'), operation_mode='dynamic')
+    replicator = Replicator(source, target)
+    resource_id = add(source, a='a')
+
+    # transactions are merged into an open last instance, keeping its id
+    path = source.get(resource_id).path.joinpath('instances', source.get(resource_id).last_instance(), 'instance.json')
+    path.write_text(path.read_text().replace('"finalized"', '"open"'))
+
+    replicator.run()
+    add(source, resource_id, a='b')
+
+    assert source.get(resource_id).config['instances'] == target.get(resource_id).config['instances']
+
+    replicator.run()
+
+    assert target.get(resource_id).read('a') == 'b'
+    assert target.get(resource_id).instances == source.get(resource_id).instances
+
+def test_replicate_deletes(tmp_path):
+    source = FileArchive(tmp_path.joinpath('source'), operation_mode='dynamic')
+    targets = [ FileArchive(tmp_path.joinpath(x), operation_mode=x) for x in [ 'dynamic', 'preservation' ] ]
+    resource_id = add(source, a='a')
+
+    for target in targets:
+        Replicator(source, target).run()
+
+    source.delete(resource_id)
+
+    for target in targets:
+        Replicator(source, target).run()
+
+    assert not targets[0].exists(resource_id)
+    assert targets[1].exists(resource_id)
@@ -0,0 +1,46 @@
+from io import BytesIO
+from json import dumps
+from os import urandom
+from threading import Thread
+from time import sleep, time
+
+import requests
+from anyio import to_thread
+
+from tiniestarchive import FileResource
+
+def test_foreground_is_served_while_ingest_is_saturated(load_app, serve, tmp_path):
+    app = load_app(IO_LIMITS=dumps({ 'ingest': { 'concurrency': 1, 'rate': 100000, 'burst': 1000 } }))
+
+    async def small_thread_pool(scope, receive, send):
+        to_thread.current_default_thread_limiter().total_tokens = 2
+        await app.app(scope, receive, send)
+
+    url = serve(small_thread_pool)
+
+    with app.archive.new() as r:
+        pass
+
+    tarballs = []
+    for i in range(6):
+        resource = FileResource(staging=tmp_path.joinpath('client'))
+        with resource.transaction() as t:
+            t.add(None, path='a', data=BytesIO(urandom(50000)))
+
+        tarballs.append(resource.serialize().read())
+
+    responses = []
+    threads = [ Thread(target=lambda x: responses.append(requests.post(url + '_ingest', files={ 'file': x })), args=(x,)) for x in tarballs ]
+    for thread in threads:
+        thread.start()
+
+    sleep(0.3)
+
+    start = time()
+    assert requests.post(url + f'{r.resource_id}/_add', files={ 'files': ('b', b'b') }).status_code == 200
+    assert time() - start < 1
+
+    for thread in threads:
+        thread.join()
+
+    assert [ x.status_code for x in responses ] == [ 200 ] * 6
@@ -0,0 +1,56 @@
+from hashlib import md5
+from os import utime
+from time import time
+
+from fastapi.testclient import TestClient
+
+def test_chunks_need_a_matching_checksum(load_app):
+    app = load_app()
+    client = TestClient(app.app)
+
+    with app.archive.new() as r:
+        pass
+
+    session = client.post(f'/{r.resource_id}/_uploads', json={ 'path': 'a', 'size': 1 }).json()
+    url = f'/{r.resource_id}/_uploads/{session["id"]}'
+
+    assert client.put(url, params={ 'offset': 0 }, content=b'a').status_code == 400
+    assert client.put(url, params={ 'offset': 0 }, content=b'a', headers={ 'X-Checksum': f'md5:{md5(b"b").hexdigest()}' }).status_code == 400
+    assert client.get(url).json()['ranges'] == []
+
+    assert client.put(url, params={ 'offset': 0 }, content=b'a', headers={ 'X-Checksum': f'md5:{md5(b"a").hexdigest()}' }).status_code == 200
+    assert client.post(f'{url}/_commit').status_code == 200
+    assert app.archive.get(r.resource_id).read('a') == 'a'
+
+def test_abandoned_sessions_expire(load_app):
+    app = load_app()
+    client = TestClient(app.app)
+
+    with app.archive.new() as r:
+        pass
+
+    old = client.post(f'/{r.resource_id}/_uploads', json={ 'path': 'a', 'size': 1 }).json()
+    recent = client.post(f'/{r.resource_id}/_uploads', json={ 'path': 'b', 'size': 1 }).json()
+
+    path = app.archive.staging.joinpath('_uploads', old['id'], 'session.json')
+    utime(path, (time() - 8*24*3600, time() - 8*24*3600))
+
+    client.post(f'/{r.resource_id}/_uploads', json={ 'path': 'c', 'size': 1 })
+
+    assert client.get(f'/{r.resource_id}/_uploads/{old["id"]}').status_code == 404
+    assert client.get(f'/{r.resource_id}/_uploads/{recent["id"]}').status_code == 200
+
+def test_commit_verifies_the_whole_file(load_app):
+    app = load_app()
+    client = TestClient(app.app)
+
+    with app.archive.new() as r:
+        pass
+
+    version = app.archive.version(r.resource_id)
+    session = client.post(f'/{r.resource_id}/_uploads', json={ 'path': 'a', 'size': 1, 'checksum': f'md5:{md5(b"b").hexdigest()}' }).json()
+    url = f'/{r.resource_id}/_uploads/{session["id"]}'
+
+    assert client.put(url, params={ 'offset': 0 }, content=b'a', headers={ 'X-Checksum': f'md5:{md5(b"a").hexdigest()}' }).status_code == 200
+    assert client.post(f'{url}/_commit').status_code == 400
+    assert app.archive.version(r.resource_id) == version
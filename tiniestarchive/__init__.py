@@ -1,4 +1,18 @@
+from importlib import import_module
 from .archive import Archive,Resource,Instance,READ,READ_BINARY,WRITE,OPEN,FINALIZED,DELETED,READ_WRITE,READ_ONLY,DYNAMIC,PRESERVATION,WORM
-from .filearchive import FileArchive,FileResource,FileInstance
-from .httparchive import HttpArchive,HttpResource
 
+# implementations are imported on first use so that e.g file-only tools
+# never pay for importing requests
+_LAZY = {
+    'FileArchive': 'filearchive',
+    'FileResource': 'filearchive',
+    'FileInstance': 'filearchive',
+    'HttpArchive': 'httparchive',
+    'HttpResource': 'httparchive',
+}
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(import_module(f'.{_LAZY[name]}', __name__), name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
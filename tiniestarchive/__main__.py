@@ -0,0 +1,227 @@
+# Command line interface, e.g
+#
+#   python -m tiniestarchive ingest /data dir1 dir2 ...
+#   python -m tiniestarchive export https://example.org/ /backup
+#   python -m tiniestarchive export /data /tape --shard-size 10G
+#   python -m tiniestarchive import /data /tape
+#   python -m tiniestarchive verify /data --state verify.jsonl
+#   python -m tiniestarchive ls /data [resource_id]
+#
+# The archive is either a path (FileArchive) or a URL (HttpArchive), only
+# ingest and import create an archive at a path that has none. Jobs run one
+# resource per worker process and, given --state, record finished items so
+# that an interrupted job can be restarted where it left off.
+# Export and verify are maintenance I/O, limited by --io-limits (JSON, as
+# IO_LIMITS for the app) that the worker processes share between them.
+# Imports are kept within the functions so that small commands start fast.
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import cpu_count, getenv
+from pathlib import Path
+from sys import exit, stderr
+
+def open_archive(spec : str, create : bool = False):
+    if spec.startswith('http'):
+        from tiniestarchive import HttpArchive
+
+        return HttpArchive(spec if spec.endswith('/') else spec + '/')
+
+    from tiniestarchive import FileArchive
+
+    # a mistyped path would otherwise become a new, empty, archive
+    if not create and not Path(spec).joinpath('config.json').exists():
+        raise Exception(f"No archive at {spec}")
+
+    return FileArchive(spec)
+
+def ingest(spec : str, directory : str) -> str:
+    archive = open_archive(spec)
+    files = sorted(p for p in Path(directory).rglob('*') if p.is_file())
+
+    if spec.startswith('http'):
+        from tiniestarchive import FileResource
+
+        # build the resource locally and send it as one tarball
+        resource = FileResource()
+        with resource.transaction() as t:
+            for f in files:
+                t.add(f, path=str(f.relative_to(directory)))
+
+        archive.ingest(resource)
+
+        return resource.resource_id
+
+    with archive.new() as resource:
+        with resource.transaction() as t:
+            for f in files:
+                t.add(f, path=str(f.relative_to(directory)))
+
+        return resource.resource_id
+
+def export(spec : str, resource_id : str, target : str) -> str:
+    from shutil import copyfileobj
+    from tiniestarchive import scheduling
+
+    path = Path(target).joinpath(f'{resource_id}.tar')
+    tmp_path = Path(target).joinpath(f'{resource_id}.tar.tmp')
+
+    with scheduling.tagged(scheduling.MAINTENANCE), tmp_path.open('wb') as f:
+        copyfileobj(open_archive(spec).serialize(resource_id), f, 1024*1024)
+
+    tmp_path.rename(path)
+
+    return str(path)
+
+def verify(spec : str, resource_id : str) -> str:
+    from hashlib import md5
+    from tiniestarchive import scheduling
+
+    resource = open_archive(spec).get(resource_id)
+    entries = _entries(resource)
+    failed = []
+
+    for path, entry in entries.items():
+        cs = md5()
+        with scheduling.tagged(scheduling.MAINTENANCE), scheduling.operation(), resource.open(path, 'rb') as f:
+            while chunk := f.read(1024*1024):
+                scheduling.throttle(len(chunk))
+                cs.update(chunk)
+
+        if f'md5:{cs.hexdigest()}' != entry.get('checksum', None):
+            failed.append(path)
+
+    if failed:
+        raise Exception(f"Checksum mismatch: {', '.join(failed)}")
+
+    return f'{len(entries)} files OK'
+
+def ls(spec : str, resource_id : str = None):
+    archive = open_archive(spec)
+
+    if not resource_id:
+        for resource_id in archive:
+            print(resource_id)
+    else:
+        for path, entry in _entries(archive.get(resource_id)).items():
+            print(f"{path}\t{entry.get('size', '')}\t{entry.get('checksum', '')}")
+
+def run(fun, items : list, extra : tuple, workers : int, state : str = None) -> bool:
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from tiniestarchive import scheduling
+
+    state = Path(state) if state else None
+    done = { loads(l)['item'] for l in state.read_text().splitlines() if l } if state and state.exists() else set()
+    todo = [ x for x in items if x not in done ]
+    ok = True
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=scheduling.configure, initargs=(scheduling.limits(workers),)) as pool:
+        futures = { pool.submit(fun, *extra[:1], x, *extra[1:]):x for x in todo }
+
+        for n, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f'[{n}/{len(todo)}] {item}: FAILED: {e}', file=stderr)
+                ok = False
+                continue
+
+            print(f'[{n}/{len(todo)}] {item}: {result}', file=stderr)
+
+            if state:
+                with state.open('a') as f:
+                    f.write(dumps({ 'item': item, 'result': result }) + '\n')
+
+    return ok
+
+def _size(s : str) -> int:
+    # e.g 1024, 100M or 10G
+    units = { 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+
+    return int(float(s[:-1]) * units[s[-1].upper()]) if s[-1].upper() in units else int(s)
+
+def _entries(resource) -> dict:
+    # current entry per path, from the manifest
+    entries = {}
+    for instance in resource.json()['instances'].values():
+        for path, entry in instance['files'].items():
+            if entry.get('status', None) == 'deleted':
+                entries.pop(path, None)
+            else:
+                entries[path] = entry
+
+    return entries
+
+def main(argv=None) -> int:
+    parser = ArgumentParser(prog='python -m tiniestarchive')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help in [ ('ingest', 'ingest each directory as a new resource'), ('export', 'serialize resources to <target>/<resource_id>.tar, or to shards'), ('import', 'ingest the resources of an exported set of shards'), ('verify', 'verify checksums of resources'), ('ls', 'list resources, or the files of a resource') ]:
+        p = commands.add_parser(name, help=help)
+        p.add_argument('archive', help='archive path or URL')
+
+        if name == 'ingest':
+            p.add_argument('dirs', nargs='+')
+        elif name == 'export':
+            p.add_argument('target')
+            p.add_argument('resources', nargs='*', help='default is all resources')
+            p.add_argument('--shard-size', type=_size, help='write shards of at most this size (e.g 10G) with an index, for archive paths only')
+        elif name == 'import':
+            p.add_argument('source', help='directory with shards and index.jsonl')
+        elif name == 'verify':
+            p.add_argument('resources', nargs='*', help='default is all resources')
+        elif name == 'ls':
+            p.add_argument('resource', nargs='?')
+
+        if name != 'ls':
+            p.add_argument('--workers', type=int, default=cpu_count())
+            p.add_argument('--state', help='job state file, to resume interrupted jobs')
+            p.add_argument('--io-limits', type=loads, default=getenv('IO_LIMITS', None), help='I/O limits per class (JSON), e.g {"maintenance": {"rate": 52428800}}')
+
+    args = parser.parse_args(argv)
+
+    if args.archive.startswith('http') and (args.command == 'import' or getattr(args, 'shard_size', None)):
+        parser.error(f'{args.command} with shards needs an archive path, not a URL')
+
+    try:
+        # ingest and import create the archive, before any worker opens it
+        open_archive(args.archive, create=args.command in [ 'ingest', 'import' ])
+    except Exception as e:
+        parser.error(str(e))
+
+    if args.command == 'ls':
+        ls(args.archive, args.resource)
+
+        return 0
+
+    if args.io_limits:
+        from tiniestarchive import scheduling
+
+        scheduling.configure(args.io_limits)
+
+    if args.command == 'ingest':
+        ok = run(ingest, [ str(Path(x).absolute()) for x in args.dirs ], (args.archive,), args.workers, args.state)
+    elif args.command in [ 'export', 'import' ] and (args.command == 'import' or args.shard_size):
+        from tiniestarchive import shards
+
+        archive = open_archive(args.archive)
+
+        if args.command == 'export':
+            n = shards.export(archive, args.target, args.resources or None, shard_size=args.shard_size, workers=args.workers)
+        else:
+            n = shards.ingest(archive, args.source, workers=args.workers)
+
+        print(f'{n} resources {args.command}ed', file=stderr)
+        ok = True
+    elif args.command == 'export':
+        Path(args.target).mkdir(parents=True, exist_ok=True)
+        ok = run(export, args.resources or list(open_archive(args.archive)), (args.archive, args.target), args.workers, args.state)
+    elif args.command == 'verify':
+        ok = run(verify, args.resources or list(open_archive(args.archive)), (args.archive,), args.workers, args.state)
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    exit(main())
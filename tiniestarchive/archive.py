@@ -19,6 +19,10 @@ PRESERVATION = 'preservation'
 
 class Archive:
     def __new__(cls, root=None, **kwargs):
+        if cls is not Archive:
+            # subclasses are instantiated as-is
+            return super().__new__(cls)
+
         if root:
             if isinstance(root, str) and root.startswith('http'):
                 return super(Archive, tiniestarchive.HttpArchive).__new__(tiniestarchive.HttpArchive)
@@ -27,6 +31,10 @@ class Archive:
 
 class Resource:
     def __new__(cls, root=None, **kwargs):
+        if cls is not Resource:
+            # subclasses are instantiated as-is
+            return super().__new__(cls)
+
         if root:
             if isinstance(root, str) and root.startswith('http'):
                 return super(Resource, tiniestarchive.HttpResource).__new__(tiniestarchive.HttpResource)
@@ -35,6 +43,10 @@ class Resource:
     
 class Instance:
     def __new__(cls, root=None, **kwargs):
+        if cls is not Instance:
+            # subclasses are instantiated as-is
+            return super().__new__(cls)
+
         if root:
             if isinstance(root, str) and root.startswith('http'):
                 return super(Instance, tiniestarchive.HttpInstance).__new__(tiniestarchive.HttpInstance)
@@ -0,0 +1,151 @@
+from itertools import takewhile
+from pathlib import Path
+from threading import local
+from typing import Iterable
+
+# An optional catalog of the current files of all resources, in SQLite, for
+# lookups that would otherwise need a walk of every instance.json: files by
+# checksum, files changed since a point in time and bytes per resource. The
+# catalog is derived, i.e it can always be rebuilt from disk, which remains
+# the single source of truth. The time a file changed is the time encoded
+# in its (uuid7) file id, or the instance id for entries without one, so a
+# rebuilt catalog is the same as one kept up to date.
+#
+# The catalog also records the position in the event log it is complete
+# up to. Updates move it on past their event only if nothing was logged in
+# between, so events of writers without the catalog, or that failed before
+# updating it, are left to sync(), which applies what was logged since.
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS files (resource TEXT, path TEXT, instance TEXT, checksum TEXT, size INTEGER, changed REAL, PRIMARY KEY (resource, path)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS files_checksum ON files (checksum)',
+    'CREATE INDEX IF NOT EXISTS files_changed ON files (changed)',
+    'CREATE INDEX IF NOT EXISTS files_path_changed ON files (path, changed)',
+    'CREATE TABLE IF NOT EXISTS resources (id TEXT PRIMARY KEY, version TEXT, files INTEGER, bytes INTEGER) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID'
+]
+
+class Catalog(object):
+    def __init__(self, path : str):
+        self.path = Path(path)
+        self._local = local()
+
+        with self._connect() as c:
+            for statement in SCHEMA:
+                c.execute(statement)
+
+    def update(self, resource, paths : Iterable[str] = None, position : tuple = None):
+        # paths changed in the resource, default is all, and the positions
+        # before and after the event of the change
+        rows, deleted = [], []
+        for path in paths if paths is not None else resource.files:
+            if path in resource.files:
+                entry = resource._entry(path)
+                instance_id = resource.files.instance_id(path)
+                rows.append((resource.resource_id, path, instance_id, entry.get('checksum', None), entry.get('size', None), _changed(entry.get('id', None) or instance_id)))
+            else:
+                deleted.append((resource.resource_id, path))
+
+        with self._connect() as c:
+            if paths is None:
+                c.execute('DELETE FROM files WHERE resource = ?', (resource.resource_id,))
+
+            c.executemany('DELETE FROM files WHERE resource = ? AND path = ?', deleted)
+            c.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+            c.execute(
+                'INSERT OR REPLACE INTO resources SELECT ?, ?, COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE resource = ?',
+                (resource.resource_id, resource.config['version'], resource.resource_id))
+
+            if position:
+                c.execute("UPDATE meta SET value = ? WHERE key = 'position' AND value = ?", (position[1], position[0]))
+
+    def delete(self, resource_id : str, position : tuple = None):
+        with self._connect() as c:
+            c.execute('DELETE FROM files WHERE resource = ?', (resource_id,))
+            c.execute('DELETE FROM resources WHERE id = ?', (resource_id,))
+
+            if position:
+                c.execute("UPDATE meta SET value = ? WHERE key = 'position' AND value = ?", (position[1], position[0]))
+
+    def position(self) -> int:
+        rows = self._query("SELECT value FROM meta WHERE key = 'position'")
+
+        return rows[0][0] if rows else None
+
+    def sync(self, archive):
+        # applies the events logged since the position of the catalog, or
+        # rebuilds it if it has none (e.g a new catalog) or the log is not
+        # the one it was built from
+        position, end = self.position(), archive.logger.position()
+
+        if position is None or position > end:
+            self.rebuild(archive)
+            return
+
+        resource_ids = dict.fromkeys(e['ref'] for e in takewhile(lambda e: e['position'] <= end, archive.events(position=position)))
+
+        for resource_id in resource_ids:
+            if archive.exists(resource_id):
+                self.update(archive.get(resource_id))
+            else:
+                self.delete(resource_id)
+
+        self._position(end)
+
+    def rebuild(self, archive):
+        # everything logged so far is on disk
+        end = archive.logger.position()
+
+        with self._connect() as c:
+            c.execute('DELETE FROM files')
+            c.execute('DELETE FROM resources')
+
+        for resource_id in archive:
+            if archive.exists(resource_id):
+                self.update(archive.get(resource_id))
+
+        self._position(end)
+
+    def find(self, checksum : str) -> list:
+        return [ { 'resource': x[0], 'path': x[1] } for x in self._query('SELECT resource, path FROM files WHERE checksum = ?', (checksum,)) ]
+
+    def changed(self, since : float, path : str = None) -> list:
+        if path:
+            rows = self._query('SELECT resource, path, changed FROM files WHERE path = ? AND changed > ? ORDER BY changed', (path, since))
+        else:
+            rows = self._query('SELECT resource, path, changed FROM files WHERE changed > ? ORDER BY changed', (since,))
+
+        return [ { 'resource': x[0], 'path': x[1], 'changed': x[2] } for x in rows ]
+
+    def usage(self, resource_ids : Iterable[str] = None) -> dict:
+        if resource_ids is None:
+            rows = self._query('SELECT id, files, bytes FROM resources')
+        else:
+            rows = [ x for resource_id in resource_ids for x in self._query('SELECT id, files, bytes FROM resources WHERE id = ?', (resource_id,)) ]
+
+        return { x[0]:{ 'files': x[1], 'bytes': x[2] } for x in rows }
+
+    def _position(self, position : int):
+        with self._connect() as c:
+            c.execute("INSERT OR REPLACE INTO meta VALUES ('position', ?)", (position,))
+
+    def _query(self, sql : str, params : tuple = ()) -> list:
+        return self._connect().execute(sql, params).fetchall()
+
+    def _connect(self) -> 'sqlite3.Connection':
+        # one connection per thread, used as context manager per transaction
+        if not hasattr(self._local, 'connection'):
+            import sqlite3
+
+            c = self._local.connection = sqlite3.connect(self.path, timeout=60)
+            c.execute('PRAGMA journal_mode=WAL')
+            c.execute('PRAGMA synchronous=NORMAL')
+
+        return self._local.connection
+
+def _changed(uuid7 : str) -> float:
+    # the unix time in milliseconds in the first 48 bits
+    try:
+        return int(uuid7.replace('-', '')[:12], 16) / 1000
+    except (AttributeError, ValueError):
+        return None
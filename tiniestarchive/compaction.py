@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from json import dumps, loads
+from pathlib import Path
+from sys import stderr
+from threading import Event, Thread
+
+from . import WRITE
+from .scheduling import MAINTENANCE, tagged
+from .filearchive import FileArchive
+from .utils import write_atomic
+
+# Compacts the resources of a FileArchive online, following the event log
+# from a checkpoint. Resources touched since the last run are compacted once
+# they have at least `min_instances` live instances.
+class Compactor(object):
+    def __init__(self, archive : FileArchive, min_instances : int = 100, checkpoint : str = None, workers : int = 2):
+        self.archive = archive
+        self.min_instances = min_instances
+        self.checkpoint = Path(checkpoint) if checkpoint else archive.root_dir.joinpath('compaction.json')
+        self.workers = workers
+        self._stopped = Event()
+
+    def position(self) -> int:
+        return loads(self.checkpoint.read_text())['position'] if self.checkpoint.exists() else 0
+
+    def run(self, batch_size : int = 1000) -> int:
+        # returns the number of resources compacted
+        n = 0
+
+        while batch := list(islice(self.archive.events(position=self.position()), batch_size)):
+            resource_ids = list(dict.fromkeys(e['ref'] for e in batch if e['event'] != 'compact'))
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                n += sum(1 for x in pool.map(self.compact, resource_ids) if x)
+
+            write_atomic(self.checkpoint, dumps({ 'position': batch[-1]['position'] }))
+
+        return n
+
+    def compact(self, resource_id : str) -> str:
+        if not self.archive.exists(resource_id):
+            return None
+
+        with tagged(MAINTENANCE):
+            return self.archive.get(resource_id, mode=WRITE).compact(min_instances=self.min_instances)
+
+    def start(self, interval : float = 60) -> Thread:
+        def loop():
+            while not self._stopped.is_set():
+                try:
+                    self.run()
+                except Exception as e:
+                    print(f'Compaction failed: {e}', file=stderr)
+
+                self._stopped.wait(interval)
+
+        self._stopped.clear()
+        t = Thread(target=loop, daemon=True)
+        t.start()
+
+        return t
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,74 @@
+import zlib
+from io import TextIOWrapper
+from pathlib import PurePath
+
+# Files are compressed while being added and the manifest records the
+# encoding next to both the original and the stored size and checksum.
+# Compression is configured with a dict such as
+#
+#   { 'method': 'gzip', 'suffixes': [ '.xml', '.json' ] }
+#
+# where a missing or empty list of suffixes means all files. The codecs are
+# imported on first use.
+
+METHODS = [ 'gzip', 'lzma', 'bz2' ]
+
+def check(compression : dict):
+    if compression and compression.get('method') not in METHODS:
+        raise Exception(f"Invalid compression method: {compression.get('method')}")
+
+def normalize(compression : dict) -> dict:
+    # suffixes are matched lowercased
+    if not compression or not compression.get('suffixes', None):
+        return compression
+
+    return { **compression, 'suffixes': [ x.lower() for x in compression['suffixes'] ] }
+
+def method_for(path : str, compression : dict) -> str:
+    if not compression:
+        return None
+
+    suffixes = compression.get('suffixes', None)
+
+    if not suffixes or PurePath(path).suffix.lower() in suffixes:
+        return compression['method']
+
+    return None
+
+def compressor(method : str):
+    if method == 'gzip':
+        # 16 + MAX_WBITS for a gzip header, i.e what gzip.open reads
+        return zlib.compressobj(wbits=31)
+    elif method == 'lzma':
+        import lzma
+        return lzma.LZMACompressor()
+    elif method == 'bz2':
+        import bz2
+        return bz2.BZ2Compressor()
+
+    raise Exception(f"Invalid compression method: {method}")
+
+def open_stored(path, mode : str = 'rb', encoding : str = None):
+    if not encoding:
+        return open(path, mode)
+
+    return decode(path, mode, encoding)
+
+def decode(f, mode : str = 'rb', encoding : str = None):
+    # f is either a path or a binary file object with the stored bytes
+    if not encoding:
+        return f if mode == 'rb' else TextIOWrapper(f)
+
+    mode = 'rt' if mode == 'r' else 'rb'
+
+    if encoding == 'gzip':
+        import gzip
+        return gzip.open(f, mode)
+    elif encoding == 'lzma':
+        import lzma
+        return lzma.open(f, mode)
+    elif encoding == 'bz2':
+        import bz2
+        return bz2.open(f, mode)
+
+    raise Exception(f"Invalid encoding: {encoding}")
@@ -0,0 +1,44 @@
+from os import O_RDONLY, close, fsync, open as os_open, walk
+from os.path import join
+
+# How writes are pushed to stable storage. Metadata is always written
+# atomically (temporary file and rename), the level decides the fsyncs:
+#
+#   none      - nothing is fsynced, a crash can lose recent commits
+#   commit    - everything a commit wrote is fsynced once, when committed:
+#               file data, then directories, then the manifest that makes
+#               it visible
+#   operation - as commit, and every single write is also fsynced as it
+#               happens
+#
+# The level is set per archive (config.json 'durability').
+
+NONE = 'none'
+COMMIT = 'commit'
+OPERATION = 'operation'
+
+def check(durability : str):
+    if durability not in [ None, NONE, COMMIT, OPERATION ]:
+        raise Exception(f"Invalid durability: {durability}")
+
+def sync_file(path):
+    fd = os_open(path, O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+def sync_dir(path):
+    # makes renames and new entries in the directory durable
+    sync_file(path)
+
+def sync_tree(path):
+    dirs = []
+    for root, _, files in walk(path, topdown=False):
+        for name in files:
+            sync_file(join(root, name))
+
+        dirs.append(root)
+
+    for d in dirs:
+        sync_dir(d)
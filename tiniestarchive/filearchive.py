@@ -1,48 +1,246 @@
+from bisect import bisect_right
+from collections import deque
 from copy import copy, deepcopy
+from datetime import datetime
+from itertools import islice
+from os import cpu_count
 from hashlib import md5
 from queue import Queue
-from shlex import split
-from subprocess import DEVNULL, PIPE, Popen, run
 from sys import stderr
 from io import BufferedIOBase, BufferedReader, BytesIO
 from json import dumps, load, loads
-from os import makedirs, listdir, remove, rename, stat
+from os import fsync, makedirs, listdir, remove, rename, stat
 from os.path import join,exists
 from posixpath import dirname
-from shutil import move,copy, rmtree
-import tarfile
+from shutil import move,copy, copyfileobj, rmtree
 from tempfile import gettempdir
-from threading import Thread
+from threading import Condition, Event, Lock, RLock, Thread
 from typing import Iterable, Union
 from .commitmanager import CommitManager
 from .ingestmanager import IngestManager
 from uuid_utils import uuid7
-from uuid import uuid4
+from uuid import UUID, uuid4
 from pathlib import Path
 from time import time
-from .utils import split_path, safe_path
+from .utils import copy_file, split_path, safe_path, transfer, write_atomic, view
+from .filelock import FileLock
+from .filetable import FileTable
+from .catalog import Catalog
+from . import compression as codecs
+from . import packing as packs
+from . import durability as durabilities
+from . import scheduling
+from .durability import NONE, COMMIT, OPERATION, sync_dir, sync_file, sync_tree
+from .scheduling import INGEST, MAINTENANCE
 from enum import Enum
 from . import Archive,Instance,READ,READ_BINARY,WRITE,OPEN,FINALIZED,DELETED,READ_ONLY,READ_WRITE,DYNAMIC,WORM,PRESERVATION
 from .queueio import open as qopen
+from .uploads import UploadSession
 from .iterio import open as iopen
 
 class EventLogger:
-    def __init__(self, filename):
+    def __init__(self, filename, sync : bool = False):
         self.filename = filename
+        self.sync = sync
+
+        # called after every event, e.g to wake up an EventStream
+        self.listeners = []
+
+    def log(self, ref : str, event : str, transaction_id : str = None) -> tuple:
+        # returns the positions before and after the event
+        x = { 'timestamp': time(), 'ref': ref, 'event': event }
+
+        if transaction_id:
+            x['transaction_id'] = transaction_id
+
+        with FileLock(self.filename), self.filename.open('ab') as f:
+            start = f.seek(0, 2)
+            f.write((dumps(x) + '\n').encode('utf-8'))
+            end = f.tell()
+
+            if self.sync:
+                f.flush()
+                fsync(f.fileno())
+
+        for listener in self.listeners:
+            listener()
+
+        return start, end
+
+    def position(self) -> int:
+        return self.filename.stat().st_size
+
+class EventStream:
+    # A single reader of log.jsonl that fans new events out to any number of
+    # subscribers. Recent events are buffered so that subscribers that are
+    # caught up never touch the file. Events logged in this process are
+    # picked up right away, events from other processes within `interval`
+    # seconds.
+    def __init__(self, filename, buffer_size : int = 10000, interval : float = 1.0):
+        self.filename = Path(filename)
+        self.buffer_size = buffer_size
+        self.interval = interval
+
+        # events and their positions, covering the log from origin on
+        self.events, self.positions = [], []
+        self.position = self.origin = self.filename.stat().st_size
+
+        self.condition = Condition()
+        self.callbacks = set()
+        self._wake = Event()
+        self._lock = Lock()
+        self._thread = None
+
+    def read(self, position : int = 0, start=None, limit : int = 1000) -> tuple:
+        # (events after position, new position), without blocking
+        start = _timestamp(start) if start else None
+
+        with self.condition:
+            if position >= self.origin:
+                i = bisect_right(self.positions, position)
+                events = self.events[i:i + limit]
+            else:
+                events = None
+
+        if events is None:
+            # too far behind for the buffer
+            events = list(islice(_read_events(self.filename, position), limit))
+
+        position = events[-1]['position'] if events else position
+
+        return [ e for e in events if not start or e['timestamp'] > start ], position
+
+    def wait(self, position : int, timeout : float = None) -> bool:
+        # until there are events after position
+        self.start()
+
+        with self.condition:
+            return self.condition.wait_for(lambda: self.position > position, timeout)
+
+    def listen(self, start=None, position : int = 0) -> Iterable[dict]:
+        self.start()
+
+        while True:
+            events, position = self.read(position, start=start)
+
+            yield from events
+
+            self.wait(position)
+
+    def subscribe(self, callback):
+        # callback() is called, from the reader thread, after new events
+        self.start()
+        self.callbacks.add(callback)
+
+    def unsubscribe(self, callback):
+        self.callbacks.discard(callback)
+
+    def notify(self):
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if not self._thread:
+                self._thread = Thread(target=self._tail, daemon=True)
+                self._thread.start()
+
+    def _tail(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            events = list(_read_events(self.filename, self.position))
+
+            if not events:
+                continue
+
+            with self.condition:
+                self.events += events
+                self.positions += [ e['position'] for e in events ]
+                self.position = events[-1]['position']
+
+                # trim in batches rather than on every event
+                if len(self.events) > 2 * self.buffer_size:
+                    n = len(self.events) - self.buffer_size
+                    self.origin = self.positions[n - 1]
+                    del self.events[:n], self.positions[:n]
+
+                self.condition.notify_all()
+
+            for callback in list(self.callbacks):
+                callback()
+
+# Stored files are either loose files under data/ or windows into packs, and
+# may be compressed. `location` is the loose file or the pack.
+
+def _check_paths(instance : Instance):
+    # instance.json may come from a client, so every path, including those
+    # of files left out of a serialized instance, has to stay within it
+    for path in instance:
+        entry = instance[path]
+
+        if safe_path(path) != path or entry.get('path', path) != path or ('pack' in entry and safe_path(entry['pack']) != entry['pack']):
+            raise Exception(f"Invalid path: {path}")
+
+def _open_entry(location : Path, entry : dict, mode : str = READ) -> BufferedIOBase:
+    if 'pack' in entry:
+        return codecs.decode(packs.open_packed(location, entry), mode, entry.get('encoding', None))
+
+    return codecs.open_stored(location, mode, entry.get('encoding', None))
+
+def _view(location : Path, entry : dict) -> memoryview:
+    if entry.get('encoding', None):
+        # compressed files can only be viewed as decompressed copies
+        with _open_entry(location, entry, READ_BINARY) as f:
+            return memoryview(f.read())
+
+    return view(location, entry.get('offset', 0), entry['size'])
+
+def _read_range(location : Path, entry : dict, offset : int, length : int) -> bytes:
+    if offset < 0 or length < 0:
+        raise Exception(f"Invalid range: {offset}, {length}")
+
+    if entry.get('encoding', None):
+        with _open_entry(location, entry, READ_BINARY) as f:
+            f.seek(offset)
+            return f.read(length)
 
-    def log(self, ref : str, event : str, transaction_id : str = None):
-        with self.filename.open('a') as f:
-            x = { 'timestamp': time(), 'ref': ref, 'event': event }
+    with open(location, READ_BINARY) as f:
+        f.seek(entry.get('offset', 0) + offset)
+        return f.read(max(0, min(length, entry['size'] - offset)))
 
-            if transaction_id:
-                x['transaction_id'] = transaction_id
+def _extract(s : BytesIO, staging : Path, tmpdir : Path) -> list:
+    # tarballs may come from clients, so members have to stay within tmpdir
+    # and the top-level names have to be ids that are not staged already
+    import tarfile
 
-            f.write(dumps(x))
+    with scheduling.operation(INGEST):
+        t = tarfile.open(fileobj=scheduling.reader(s), mode='r|')
+        t.extractall(path=tmpdir, filter='data')
+
+    names = listdir(tmpdir)
+
+    for name in names:
+        try:
+            valid = str(UUID(name)) == name
+        except ValueError:
+            valid = False
+
+        if not valid or staging.joinpath(name).exists():
+            raise Exception(f"Invalid tarball: {name}")
+
+    return names
 
 class FileInstance(Instance):
-    def __init__(self, path : str = None, mode : str = None, force_temporary=False):
+    def __init__(self, path : str = None, mode : str = None, force_temporary=False, staging : str = None, compression : dict = None, durability : str = None):
+        codecs.check(compression)
+        durabilities.check(durability)
+
         self.temporary = path is None or force_temporary
-        self.path = Path(path) if path else Path(gettempdir()).joinpath(str(uuid4()))
+        self.compression = codecs.normalize(compression)
+        self.durability = durability or NONE
+        self.staging = Path(staging or gettempdir())
+        self.path = Path(path) if path else self.staging.joinpath(str(uuid4()))
         self.mode = (mode or READ) if path and not force_temporary else WRITE
 
         if not self.path.exists() and self.mode == WRITE:
@@ -54,21 +252,31 @@ class FileInstance(Instance):
         self.instance_id = self.config['id']
 
         if self.mode == WRITE and self.config['status'] == FINALIZED:
-            raise Exception('Instance is finalized')
+            if not force_temporary:
+                raise Exception('Instance is finalized')
+
+            # e.g a deserialized, already finalized, transaction
+            self.mode = READ
 
     def open(self, path, mode=READ) -> BufferedIOBase:
         if mode not in [ READ, READ_BINARY ]:
             raise Exception(f"Invalid mode: {mode}")
 
-        return open(self._resolve(path), mode)
+        return _open_entry(self._location(path), self.config['files'][path], mode)
 
     def read(self, path, mode=READ) -> Union[str,bytes]:
         if mode not in [ READ, READ_BINARY ]:
             raise Exception(f"Invalid mode: {mode}")
 
-        return self._resolve(path).read(mode)
         with self.open(path, mode) as f:
             return f.read()       
+
+    def view(self, path) -> memoryview:
+        # zero-copy, memory-mapped, unless the file is compressed
+        return _view(self._location(path), self.config['files'][path])
+
+    def read_range(self, path, offset : int, length : int) -> bytes:
+        return _read_range(self._location(path), self.config['files'][path], offset, length)
         
     def delete(self, path : str):
         if self.mode != 'w':
@@ -86,32 +294,45 @@ class FileInstance(Instance):
         # catastrophic loss of connection to the storage. With no way to
         # recover this would leave the instance in an inconsistent state.
         # However, individual files will be either written in full or not at
-        # all since shutil.move is atomic within the same filesystem
+        # all since transfer is atomic
         if self.mode != WRITE:
             raise Exception("Merging instances only allowed in 'w' mode")
 
+        targets = []
         for path in instance:
             if instance[path].get('status', None) == DELETED:
                 self.delete(path)
             else:
-                source = instance._resolve(path)
                 target = self._resolve(path)
+                target.parent.mkdir(parents=True, exist_ok=True)
 
-                # will shutil.move be nonatomic?
-                if stat(source).st_dev != stat(target.parent).st_dev:
-                    tmp_target = f'{target}-tmp-{str(uuid7())}'
-                    move(source, tmp_target)
-                    source = tmp_target
+                if 'pack' in instance[path]:
+                    # packs belong to their instance, so the stored bytes
+                    # are copied out as a loose file
+                    tmp_path = target.with_name(f'{target.name}-tmp-{uuid4()}')
+                    with packs.open_packed(instance._location(path), instance[path]) as f, open(tmp_path, 'wb') as g:
+                        copyfileobj(f, g)
 
-                # this operation is atomic
-                rename(source, target)
+                    rename(tmp_path, target)
+                else:
+                    transfer(instance._resolve(path), target)
+
+                targets.append(target)
+
+                self.config['files'][path] = { k:v for k, v in instance[path].items() if k not in [ 'pack', 'offset' ] }
+
+        # this is a commit, so only the merged files are synced
+        if self.durability != NONE:
+            for target in targets:
+                sync_file(target)
 
-                self.config['files'][path] = instance[path]
+            for d in { target.parent for target in targets }:
+                sync_dir(d)
 
         self.config['version'] = str(uuid7())
-        self._save()
+        self._save(sync=self.durability != NONE)
 
-    def add(self, filename, path : str = None, data : BufferedReader = None, checksum : str = None):
+    def add(self, filename, path : str = None, data : BufferedReader = None, checksum : str = None, compression : str = None):
         if self.mode != WRITE:
             raise Exception("Adding files only allowed in 'w' mode")
 
@@ -119,22 +340,47 @@ class FileInstance(Instance):
             path = Path(filename).name
             
         tmpfile = Path(f'{self._resolve(path)}-tmp-{str(uuid7())}')
+        encoding = compression or codecs.method_for(path, self.compression)
 
         with (data or open(filename, 'rb')) as d:
             try:
                 tmpfile.parent.mkdir(parents=True, exist_ok=True)
 
-                cs,size = md5(), 0
+                # checksum both the original and the stored bytes in one pass
+                cs, size, stored_cs, stored_size = md5(), 0, md5(), 0
+                c = codecs.compressor(encoding) if encoding else None
                 with open(tmpfile, 'wb') as f:
                     while chunk := d.read(1024):
+                        scheduling.throttle(len(chunk))
                         cs.update(chunk)
-                        size += f.write(chunk)
+                        size += len(chunk)
+
+                        chunk = c.compress(chunk) if c else chunk
+                        stored_cs.update(chunk)
+                        stored_size += f.write(chunk)
+
+                    if c:
+                        chunk = c.flush()
+                        stored_cs.update(chunk)
+                        stored_size += f.write(chunk)
 
-                if checksum and checksum.lower() == cs.hexdigest().lower():
+                    if self.durability == OPERATION:
+                        f.flush()
+                        fsync(f.fileno())
+
+                if checksum and checksum.lower().removeprefix('md5:') != cs.hexdigest().lower():
                     raise Exception('Checksum mismatch')
 
                 tmpfile.rename(self._resolve(path))
+
+                if self.durability == OPERATION:
+                    sync_dir(tmpfile.parent)
+
                 self.config['files'][path] = { 'id': str(uuid7()), 'path': path, 'size': size, 'checksum': f'md5:{cs.hexdigest()}' }
+
+                if encoding:
+                    self.config['files'][path].update({ 'encoding': encoding, 'stored_size': stored_size, 'stored_checksum': f'md5:{stored_cs.hexdigest()}' })
+
                 self._save()
             except Exception as e:
                 if exists(tmpfile):
@@ -142,6 +388,40 @@ class FileInstance(Instance):
                     
                 raise e
 
+    def adopt(self, filename, path : str, checksum : str = None):
+        # add a file by renaming it into the instance rather than copying
+        # it, e.g an assembled upload in the staging area
+        if self.mode != WRITE:
+            raise Exception("Adding files only allowed in 'w' mode")
+
+        path = safe_path(path)
+
+        if codecs.method_for(path, self.compression):
+            self.add(filename, path=path, checksum=checksum)
+            remove(filename)
+
+            return
+
+        cs, size = md5(), 0
+        with open(filename, 'rb') as f:
+            while chunk := f.read(1024*1024):
+                scheduling.throttle(len(chunk))
+                cs.update(chunk)
+                size += len(chunk)
+
+        if checksum and checksum.lower().removeprefix('md5:') != cs.hexdigest().lower():
+            raise Exception('Checksum mismatch')
+
+        self._resolve(path).parent.mkdir(parents=True, exist_ok=True)
+        transfer(filename, self._resolve(path))
+
+        if self.durability == OPERATION:
+            sync_file(self._resolve(path))
+            sync_dir(self._resolve(path).parent)
+
+        self.config['files'][path] = { 'id': str(uuid7()), 'path': path, 'size': size, 'checksum': f'md5:{cs.hexdigest()}' }
+        self._save()
+
     def finalize(self):
         if self.config['status'] == FINALIZED:
             raise Exception('Instance is already finalized')
@@ -149,6 +429,12 @@ class FileInstance(Instance):
         self.config['status'] = FINALIZED
         self._save()
 
+    def pack(self, threshold : int = packs.THRESHOLD, size : int = packs.PACK_SIZE):
+        # only changes how files are stored, not the content of the instance
+        packs.pack(self.path, self.config['files'], threshold=threshold, size=size)
+        self._save()
+        packs.cleanup(self.path, self.config['files'])
+
     def create(path : str):
         path = Path(path)
         if path.exists():
@@ -172,41 +458,75 @@ class FileInstance(Instance):
     def json(self) -> dict:
         return deepcopy(self.config)
 
-    def serialize(self, as_iter=False, buffer_size=1024) -> Union[BytesIO,Iterable[bytes]]:
+    def serialize(self, as_iter=False, buffer_size=1024, exclude : Iterable[str] = None) -> Union[BytesIO,Iterable[bytes]]:
+        # exclude leaves out the data of files, e.g those that the receiving
+        # end already has, while instance.json still lists them
+        from shlex import split
+        from subprocess import DEVNULL, PIPE, Popen
+
+        io_class = scheduling.current()
+
         def i():
-            cmd = f'/usr/bin/tar -cf - -C {self.path.parent.absolute()} {self.path.name}'
-            p = Popen(split(cmd), stdout=PIPE, stderr=DEVNULL)
+            if exclude:
+                skip = set(exclude)
+                members = [ 'instance.json' ] + list(dict.fromkeys(e.get('pack', join('data', x)) for x, e in self.config['files'].items() if x not in skip and e.get('status', None) != DELETED))
+                p = Popen([ '/usr/bin/tar', '-cf', '-', '-C', str(self.path.parent.absolute()), '--no-recursion', '--null', '-T', '-' ], stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+
+                def w():
+                    p.stdin.write(b''.join(join(self.path.name, x).encode('utf-8') + b'\0' for x in members))
+                    p.stdin.close()
+
+                Thread(target=w, daemon=True).start()
+            else:
+                cmd = f'/usr/bin/tar -cf - -C {self.path.parent.absolute()} {self.path.name}'
+                p = Popen(split(cmd), stdout=PIPE, stderr=DEVNULL)
 
             while b := p.stdout.read(buffer_size):
+                scheduling.throttle(len(b), io_class)
                 yield b
 
         return i() if as_iter else iopen(i(), mode='rb')
     
-    def deserialize(s : BytesIO):
-        tmpdir = Path(gettempdir()).joinpath(str(uuid4()))
-        tmpdir.mkdir()
-        t = tarfile.open(fileobj=s, mode='r|')
-        t.extractall(path=tmpdir)
+    def deserialize(s : BytesIO, staging : str = None):
+        staging = Path(staging or gettempdir())
+        tmpdir = staging.joinpath(str(uuid4()))
+        tmpdir.mkdir(parents=True)
 
-        print(tmpdir, file=stderr)
+        try:
+            # find instance directory
+            instance_ids = _extract(s, staging, tmpdir)
 
-        # find instance directory
-        if len(listdir(tmpdir)) != 1:
-            raise Exception('Invalid tarball')
-        else:
-            instance_id = listdir(tmpdir)[0]
-            move(tmpdir.joinpath(instance_id), Path(gettempdir()).joinpath(instance_id))
-            rmtree(tmpdir)
+            if len(instance_ids) != 1:
+                raise Exception('Invalid tarball')
 
-            return FileInstance(Path(gettempdir()).joinpath(instance_id), force_temporary=True)
+            instance_id = instance_ids[0]
+            rename(tmpdir.joinpath(instance_id), staging.joinpath(instance_id))
+
+            return FileInstance(staging.joinpath(instance_id), force_temporary=True, staging=staging)
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
 
     def _resolve(self, path : Union[str,Path]) -> Path:
         return self.path.joinpath('data', path)
 
-    def _save(self):
+    def _location(self, path : str) -> Path:
+        entry = self.config['files'][path]
+
+        return self.path.joinpath(entry['pack']) if 'pack' in entry else self._resolve(path)
+
+    def sync(self):
+        # file data, then directories, then instance.json
+        sync_tree(self.path.joinpath('data'))
+
+        if self.path.joinpath('packs').exists():
+            sync_tree(self.path.joinpath('packs'))
+
+        sync_file(self.path.joinpath('instance.json'))
+        sync_dir(self.path)
+
+    def _save(self, sync : bool = None):
         self.config['version'] = str(uuid7())
-        with open(join(self.path, 'instance.json'), 'w') as f:
-            f.write(dumps(self.config, indent=4))
+        write_atomic(join(self.path, 'instance.json'), dumps(self.config, indent=4), sync=self.durability == OPERATION if sync is None else sync)
 
     def _remove(self, path):
         del(self.config['files'][path])
@@ -228,7 +548,7 @@ class FileInstance(Instance):
     def __del__(self):
         if self.temporary:
             try:
-                if (gettempdir() in str(self.path)):
+                if str(self.staging) in str(self.path):
                     #print("DELETED!", file=stderr) 
                     rmtree(self.path)
             except:
@@ -242,8 +562,18 @@ class FileInstance(Instance):
         ...
 
 class FileResource:
-    def __init__(self, path : str = None, close_transactions = True, mode : str = None, force_temporary=True):
-        self.path = Path(path) if path else Path(gettempdir()).joinpath(str(uuid4()))
+    def __init__(self, path : str = None, close_transactions = True, mode : str = None, force_temporary=True, staging : str = None, compression : dict = None, packing : dict = None, logger : EventLogger = None, durability : str = None, catalog : Catalog = None):
+        codecs.check(compression)
+        packs.check(packing)
+        durabilities.check(durability)
+
+        self.logger = logger
+        self.catalog = catalog
+        self.durability = durability or NONE
+        self.staging = Path(staging or gettempdir())
+        self.compression = codecs.normalize(compression)
+        self.packing = packing
+        self.path = Path(path) if path else self.staging.joinpath(str(uuid4()))
         self.force_temporary = force_temporary
         self.close_transactions = close_transactions
         self.mode = (mode or READ) if path and not force_temporary else WRITE
@@ -251,6 +581,11 @@ class FileResource:
         if not self.path.exists() and self.mode == WRITE:
             FileResource.create(self.path)
 
+        # writers lock the resource, readers never do. Temporary resources,
+        # e.g staged ones, are private to this process and lock in memory, so
+        # that no lock file is left behind
+        self.lock = FileLock(self.path.parent.joinpath(f'{self.path.name}.lock')) if not force_temporary else RLock()
+
         self._reload()
 
         self.resource_id = self.config['id']
@@ -260,44 +595,183 @@ class FileResource:
 
         return CommitManager(
                     self,
-                    lambda x: FileInstance(x, mode=WRITE),
-                    finalize=self.close_transactions)
+                    lambda x: FileInstance(x, mode=WRITE, staging=self.staging, compression=self.compression, durability=self.durability),
+                    finalize=self.close_transactions,
+                    tmpdir=self.staging.joinpath(str(uuid4())))
 
     def update(self, instance : Instance):
         self._writable_check()
+        _check_paths(instance)
+
+        with scheduling.operation(), self.lock:
+            self._update(instance)
+
+    def _update(self, instance : Instance):
+        # another writer might have added instances since we loaded
+        self._reload()
 
         if not self.close_transactions and self.last_instance() and self.get_instance(self.last_instance()).status() == OPEN:
             # open in write-mode to merge the instances
-            last_instance = self.get_instance(self.last_instance(), mode=WRITE)
+            last_instance = self.get_instance(self.last_instance(), mode=WRITE, durability=self.durability)
             last_instance.update(instance)
-        else:
-            instance.finalize()
 
-            # would shutil.move be nonatomic?
-            instance_path = instance.path
+            # bump version so that cached manifests are invalidated
+            self._save()
+            self._reload()
 
-            if stat(join(self.path, 'instances')).st_dev != stat(instance_path).st_dev:
-                tmp_target = self.path.joinpath('instances', f'tmp-{str(uuid7())}')
-                move(instance_path, tmp_target)
-                instance_path = tmp_target
+            position = self.logger.log(self.resource_id, 'update', last_instance.instance_id) if self.logger else None
+
+            if self.catalog:
+                self.catalog.update(self, list(instance), position=position)
+        else:
+            if instance.status() != FINALIZED:
+                instance.finalize()
+
+            if self.packing:
+                instance.pack(**self.packing)
 
             # inject resource id into instance in a fugly way
-            j = loads(instance_path.joinpath('instance.json').read_text())
+            j = loads(instance.path.joinpath('instance.json').read_text())
             j['resource'] = self.resource_id
-            instance_path.joinpath('instance.json').write_text(dumps(j, indent=4))
+            write_atomic(instance.path.joinpath('instance.json'), dumps(j, indent=4))
+
+            if self.durability != NONE:
+                instance.sync()
+
+            # this operation is atomic, and a rename as long as the instance
+            # was staged on the same filesystem
+            transfer(instance.path, self.path.joinpath('instances', instance.instance_id))
 
-            # this operation is atomic
-            move(instance_path, join(self.path, 'instances', instance.instance_id))
+            if self.durability != NONE:
+                sync_dir(self.path.joinpath('instances'))
 
             self.config['instances'].append(instance.instance_id)
 
             self._save()
             self._reload()
 
-    def get_instance(self, instance_id : str, mode : str = READ) -> FileInstance:
+            position = self.logger.log(self.resource_id, 'update', instance.instance_id) if self.logger else None
+
+            if self.catalog:
+                self.catalog.update(self, list(instance), position=position)
+
+    def have(self, entries : Iterable[dict]) -> list:
+        # paths of the entries ({ 'path', 'checksum', 'size' }) with content
+        # the resource already stores, so that a client can leave them out
+        checksums = self.checksums
+
+        return [ x['path'] for x in entries if x.get('checksum', None) in checksums and self._entry(checksums[x['checksum']]).get('size', None) == x.get('size', None) ]
+
+    def complete(self, instance : FileInstance):
+        # copies the files that were left out of a serialized instance, see
+        # have(), from the resource
+        _check_paths(instance)
+
+        for path in instance:
+            entry, target = instance[path], instance._resolve(path)
+
+            if entry.get('status', None) == DELETED or 'pack' in entry or target.exists():
+                continue
+
+            source = self.checksums.get(entry.get('checksum', None), None)
+
+            if source is None or 'encoding' in entry or self._entry(source).get('size', None) != entry.get('size', None):
+                raise Exception(f'Missing file: {path}')
+
+            target.parent.mkdir(parents=True, exist_ok=True)
+
+            if self.packed(source) or self.encoding(source):
+                scheduling.throttle(entry['size'])
+
+                with self.open(source, mode=READ_BINARY) as f, open(target, 'wb') as t:
+                    copyfileobj(f, t, 1024*1024)
+            else:
+                copy_file(self._resolve(source), target)
+
+    def compact(self, min_instances : int = 2) -> str:
+        with scheduling.operation():
+            return self._compact(min_instances)
+
+    def _compact(self, min_instances : int) -> str:
+        # Merge-on-migrate: consolidate the live instances into one instance
+        # without tombstones, marked with the instances it replaces so that
+        # readers skip everything before it. In DYNAMIC mode the replaced
+        # instances are removed, otherwise they are kept as they are. Files
+        # are copied outside of the lock, so if the resource changed in the
+        # meantime nothing is committed and None is returned.
+        self._writable_check()
+        self._reload()
+
+        live = [ x for x in self.config['instances'] if x in self.instances ]
+        if len(live) < min_instances:
+            return None
+
+        snapshot = (list(self.config['instances']), self.instances[live[-1]]['version'])
+        instance = FileInstance(mode=WRITE, staging=self.staging, durability=self.durability)
+
+        for path in self.files:
+            # stored bytes are copied as they are, i.e still compressed
+            target = instance._resolve(path)
+            target.parent.mkdir(parents=True, exist_ok=True)
+
+            if self.packed(path):
+                scheduling.throttle(self._entry(path).get('stored_size', self._entry(path)['size']))
+
+                with self.open_stored(path) as f, open(target, 'wb') as t:
+                    copyfileobj(f, t, 1024*1024)
+            else:
+                copy_file(self._resolve(path), target)
+
+            instance.config['files'][path] = { k:v for k,v in self._entry(path).items() if k not in [ 'pack', 'offset' ] }
+
+        instance.config['resource'] = self.resource_id
+        instance.config['compacted'] = live
+
+        with self.lock:
+            self._reload()
+
+            if (self.config['instances'], self.instances.get(live[-1], {}).get('version', None)) != snapshot:
+                return None
+
+            # an open instance stays open for later transactions to merge into
+            if self.close_transactions or self.instances[live[-1]]['status'] != OPEN:
+                instance.finalize()
+
+                if self.packing:
+                    instance.pack(**self.packing)
+            else:
+                instance._save()
+
+            if self.durability != NONE:
+                instance.sync()
+
+            transfer(instance.path, self.path.joinpath('instances', instance.instance_id))
+
+            if self.durability != NONE:
+                sync_dir(self.path.joinpath('instances'))
+
+            # transactions are only left open in DYNAMIC mode
+            replaced = self.config['instances']
+            self.config['instances'] = [ instance.instance_id ] if not self.close_transactions else replaced + [ instance.instance_id ]
+
+            self._save()
+            self._reload()
+
+            if not self.close_transactions:
+                for instance_id in replaced:
+                    rmtree(self.path.joinpath('instances', instance_id), ignore_errors=True)
+
+            position = self.logger.log(self.resource_id, 'compact', instance.instance_id) if self.logger else None
+
+            if self.catalog:
+                self.catalog.update(self, position=position)
+
+        return instance.instance_id
+
+    def get_instance(self, instance_id : str, mode : str = READ, durability : str = None) -> FileInstance:
         instance_path = join(self.path, 'instances', instance_id)
 
-        return FileInstance(instance_path, mode=mode)
+        return FileInstance(instance_path, mode=mode, durability=durability)
 
     def last_instance(self) -> str:
         return self.config['instances'][-1] if len(self.config['instances']) > 0 else None
@@ -306,7 +780,14 @@ class FileResource:
         if mode not in [ READ, READ_BINARY ]:
             raise Exception(f"Invalid mode: {mode}")
 
-        return open(self._resolve(path), mode)
+        return _open_entry(self._resolve(path), self._entry(path), mode)
+
+    def open_stored(self, path) -> BufferedIOBase:
+        # the bytes as stored, i.e possibly compressed
+        if self.packed(path):
+            return packs.open_packed(self._resolve(path), self._entry(path))
+
+        return open(self._resolve(path), READ_BINARY)
 
     def read(self, path, mode=READ) -> Union[str,bytes]:
         if mode not in [ READ, READ_BINARY ]:
@@ -315,9 +796,23 @@ class FileResource:
         with self.open(path, mode) as f:
             return f.read()       
 
+    def view(self, path) -> memoryview:
+        # zero-copy, memory-mapped, unless the file is compressed
+        return _view(self._resolve(path), self._entry(path))
+
+    def read_range(self, path, offset : int, length : int) -> bytes:
+        return _read_range(self._resolve(path), self._entry(path), offset, length)
+
     def exists(self, path : str) -> bool:
         return path in self.files
 
+    def encoding(self, path : str) -> str:
+        # at-rest compression of the stored file, if any
+        return self._entry(path).get('encoding', None)
+
+    def packed(self, path : str) -> bool:
+        return 'pack' in self._entry(path)
+
     def create(path : str):
         resource_id = str(uuid7())
 
@@ -334,45 +829,98 @@ class FileResource:
                       'instances': []
                     }, indent=4))
 
-    def serialize(self, as_iter=False, buffer_size=10*1024) -> Union[BytesIO,Iterable[bytes]]:
+    def serialize(self, as_iter=False, buffer_size=10*1024, instance_id : str = None) -> Union[BytesIO,Iterable[bytes]]:
+        if instance_id:
+            return self.get_instance(instance_id).serialize(as_iter=as_iter, buffer_size=buffer_size)
+
+        from shlex import split
+        from subprocess import DEVNULL, PIPE, Popen
+
+        io_class = scheduling.current()
+
         def i(buffer_size=10*1024):
             cmd = f'/usr/bin/tar -cf - -C {self.path.parent.absolute()} {self.path.name}'
             p = Popen(split(cmd), stdout=PIPE, text=False, stderr=DEVNULL)
 
             while b := p.stdout.read(buffer_size):
+                scheduling.throttle(len(b), io_class)
                 yield b
 
             #print(p.returncode, file=stderr)
             
-        return i(buffer_size) if as_iter else iopen(i(buffer_size))
+        return i(buffer_size) if as_iter else iopen(i(buffer_size), mode='rb')
 
-    def deserialize(s : BytesIO):
-        tmpdir = Path(gettempdir()).joinpath(str(uuid4()))
-        tmpdir.mkdir()
-        t = tarfile.open(fileobj=s, mode='r|')
-        t.extractall(path=tmpdir)
+    def deserialize(s : BytesIO, staging : str = None):
+        resources = FileResource.deserialize_many(s, staging=staging)
 
-        # find instance directory
-        if len(listdir(tmpdir)) != 1:
+        if len(resources) != 1:
             raise Exception('Invalid tarball')
-        else:
-            instance_id = listdir(tmpdir)[0]
-            move(tmpdir.joinpath(instance_id), Path(gettempdir()).joinpath(instance_id))
-            rmtree(tmpdir)
 
-            return FileResource(Path(gettempdir()).joinpath(instance_id), force_temporary=True)
+        return resources[0]
+
+    def deserialize_many(s : BytesIO, staging : str = None) -> list:
+        # a tarball with one or more serialized resources
+        staging = Path(staging or gettempdir())
+        tmpdir = staging.joinpath(str(uuid4()))
+        tmpdir.mkdir(parents=True)
+
+        try:
+            resource_ids = _extract(s, staging, tmpdir)
+
+            if len(resource_ids) == 0:
+                raise Exception('Invalid tarball')
+
+            resources = []
+            for resource_id in resource_ids:
+                rename(tmpdir.joinpath(resource_id), staging.joinpath(resource_id))
+                resources.append(FileResource(staging.joinpath(resource_id), force_temporary=True, staging=staging))
+
+            return resources
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
 
     def json(self) -> dict:
-        ret = loads(self.path.joinpath('resource.json').read_text())
-        ret.update({ 'instances': { instance_id:loads(self.path.joinpath('instances', instance_id, 'instance.json').read_text()) for instance_id in ret['instances'] } })
-        ret['files'] = deepcopy(self.files)
+        # manifests are built on request, so nothing is shared
+        return self.manifest()
+
+    def manifest(self, fields : Iterable[str] = None, cursor : str = None, limit : int = None) -> dict:
+        # fields: any of 'summary', 'instances' and 'files' (default all). The
+        # summary (id, version and instance ids) is always included. Files are
+        # ordered by path and paged using the last path of the previous page
+        # as cursor.
+        fields = set(fields or [ 'summary', 'instances', 'files' ])
+
+        if not fields <= { 'summary', 'instances', 'files' }:
+            raise Exception(f"Invalid fields: {fields}")
+
+        if limit is not None and limit < 1:
+            raise Exception(f"Invalid limit: {limit}")
+
+        ret = { 'id': self.config['id'], 'version': self.config['version'], 'instances': list(self.config['instances']) }
+
+        if 'instances' in fields:
+            ret['instances'] = { instance_id:self._instance(instance_id) for instance_id in self.config['instances'] if instance_id in self.instances }
+
+        if 'files' in fields:
+            if cursor is None and limit is None:
+                ret['files'] = dict(self.files.items())
+            else:
+                if self._paths is None:
+                    self._paths = sorted(self.files)
+
+                start = bisect_right(self._paths, cursor) if cursor is not None else 0
+                end = min(start + limit, len(self._paths)) if limit else len(self._paths)
+                ret['files'] = { path:self.files[path] for path in self._paths[start:end] }
+
+                if end < len(self._paths):
+                    ret['next'] = self._paths[end - 1]
 
         return ret
 
     def _save(self):
+        # every save of resource.json is a commit
         self.config['version'] = str(uuid7())
-        with open(join(self.path, 'resource.json'), 'w') as f:
-            f.write(dumps(self.config, indent=4))
+        write_atomic(join(self.path, 'resource.json'), dumps(self.config, indent=4), sync=self.durability != NONE)
 
     def __iter__(self):
         return iter(self.config['instances'])
@@ -390,21 +938,36 @@ class FileResource:
         with open(join(self.path, 'resource.json'), 'r') as f:
             self.config = load(f)
 
-        # create resolve and checksum maps
-        self.files, self.checksums = {}, {}
-        for instance_id in self.config['instances']:
+        # only instances from the last compacted one and on are live
+        live = []
+        for instance_id in reversed(self.config['instances']):
             with open(join(self.path, 'instances', instance_id, 'instance.json')) as f:
-                j = load(f)
+                live.append((instance_id, load(f)))
 
-            self.files.update(
-                {
-                  x['path']:(join('instances', instance_id, 'data', x['path']) if x.get('status', None) != DELETED else None)
-                  for x in j['files'].values()
-                })
-            
-            self.checksums.update({ x['checksum']:x['path'] for x in j['files'].values() if x.get('checksum', None) })
+            if 'compacted' in live[-1][1]:
+                break
 
-        self.files = { k:v for k,v in self.files.items() if v }
+        # create resolve and checksum maps, only the instance headers are
+        # kept since the table has the entries of all current files
+        self.files, self.instances, self._paths = FileTable(sum(len(j['files']) for _, j in live)), {}, None
+        while live:
+            # oldest first, releasing each document once it is in the table
+            instance_id, j = live.pop()
+            self.files.update(instance_id, j['files'].values())
+
+            self.instances[instance_id] = { k:v for k,v in j.items() if k != 'files' }
+
+    @property
+    def checksums(self):
+        # checksum -> path of the current files
+        return self.files.checksums
+
+    def _entry(self, path : str) -> dict:
+        return self.files.entry(path)
+
+    def _instance(self, instance_id : str) -> dict:
+        with open(join(self.path, 'instances', instance_id, 'instance.json')) as f:
+            return load(f)
 
     def _resolve(self, path : str, instance_id : str = None) -> Path:
         if instance_id:
@@ -416,29 +979,35 @@ class FileResource:
         return f"<FileResource({self.resource_id}) @ {self.path}>"
     
     def __enter__(self):
-        # TODO: lock resource if in write mode
+        if self.mode == WRITE:
+            self.lock.__enter__()
+
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
-        # TODO release lock if in write mode
-        ...
+        if self.mode == WRITE:
+            self.lock.__exit__(exc_type, exc_value, traceback)
 
     def __del__(self):
         if self.force_temporary:
             try:
-                if gettempdir() in str(self.path):
+                if str(self.staging) in str(self.path):
                     rmtree(self.path, ignore_errors=True)
             except:
                 # Ignore since gettempdir() fails when python is exiting
                 pass
 
 class FileArchive:
-    def __init__(self, path : str = None, operation_mode : str = None):
+    def __init__(self, path : str = None, operation_mode : str = None, staging : str = None, compression : dict = None, packing : dict = None, durability : str = None, catalog : bool = None):
+        codecs.check(compression)
+        packs.check(packing)
+        durabilities.check(durability)
+
         if operation_mode not in [ None, DYNAMIC, WORM, PRESERVATION ]:
             raise Exception(f"Invalid operation mode: {operation_mode}")
 
         self.temporary = path is None
-        self.root_dir = Path(path if path else gettempdir().joinpath(str(uuid4()))).absolute()
+        self.root_dir = Path(path if path else Path(gettempdir()).joinpath(str(uuid4()))).absolute()
         self.operation_mode = operation_mode or PRESERVATION
 
         if not self.root_dir.exists():
@@ -447,77 +1016,269 @@ class FileArchive:
         if self.root_dir.joinpath('config.json').exists():
             self.config = loads(self.root_dir.joinpath('config.json').read_text())
         elif len(listdir(self.root_dir)) == 0:
-            self.config = { 'mode': 'read-write', 'operation_mode': self.operation_mode }
-            self.root_dir.joinpath('config.json').write_text(dumps(self.config, indent=4))
+            self.config = { 'mode': 'read-write', 'operation_mode': self.operation_mode, 'compression': compression, 'packing': packing, 'durability': durability or COMMIT, 'catalog': bool(catalog) }
+            write_atomic(self.root_dir.joinpath('config.json'), dumps(self.config, indent=4))
             self.root_dir.joinpath('resources.txt').write_text('')
             self.root_dir.joinpath('log.jsonl').write_text('')
         else:
             raise Exception('Invalid archive')
 
-        if operation_mode and self.operation_mode != operation_mode:
+        if operation_mode and self.config['operation_mode'] != operation_mode:
             raise Exception(f"Operation mode cannot be changed")
 
+        self.operation_mode = self.config['operation_mode']
         self.mode = self.config['mode']
 
-        self.logger = EventLogger(self.root_dir.joinpath('log.jsonl'))
+        # compression and packing only apply to new instances so they can
+        # be changed freely, as can durability
+        self.compression = codecs.normalize(compression or self.config.get('compression', None))
+        self.packing = packing or self.config.get('packing', None)
+        self.durability = durability or self.config.get('durability', COMMIT)
+
+        # all transactions and ingests are staged here, on the same
+        # filesystem as the archive, so that commits are plain renames
+        self.staging = Path(staging).absolute() if staging else self.root_dir.joinpath('_staging')
+        self.staging.mkdir(parents=True, exist_ok=True)
+
+        self.logger = EventLogger(self.root_dir.joinpath('log.jsonl'), sync=self.durability != NONE)
+        self._stream, self._stream_lock = None, Lock()
+
+        # the catalog is derived from disk, so it can be enabled at any time.
+        # It is then recorded in config.json for every process that opens the
+        # archive to keep it up to date, and brought up to date with the
+        # event log by one of the processes that open it (e.g uvicorn
+        # workers), i.e built the first time
+        self.catalog = None
+        if catalog if catalog is not None else self.config.get('catalog', False):
+            with FileLock(self.root_dir.joinpath('catalog.lock')):
+                if not self.config.get('catalog', False):
+                    self.config['catalog'] = True
+                    write_atomic(self.root_dir.joinpath('config.json'), dumps(self.config, indent=4))
+
+                self.catalog = Catalog(self.root_dir.joinpath('catalog.sqlite'))
+                self.catalog.sync(self)
 
     def get(self, resource_id: str, mode : str = READ) -> FileResource:
         if mode not in [ READ, WRITE ]:
             raise Exception(f"Invalid mode: {mode}")
         
-        if mode != READ and self.mode == READ:
+        if mode != READ and self.mode == READ_ONLY:
             raise Exception('Archive is not in read-write mode')
 
-        return FileResource(self._resolve(resource_id), close_transactions=self.operation_mode in [ PRESERVATION, WORM ], mode=mode)
+        return FileResource(self._resolve(resource_id), close_transactions=self.operation_mode in [ PRESERVATION, WORM ], mode=mode, force_temporary=False, staging=self.staging, compression=self.compression, packing=self.packing, logger=self.logger, durability=self.durability, catalog=self.catalog)
 
     def new(self) -> IngestManager:
         if self.mode != READ_WRITE:
             raise Exception('Archive is not in read-write mode')
 
-        tmpdir = Path(gettempdir()).joinpath(str(uuid4()))
+        tmpdir = self.staging.joinpath(str(uuid4()))
 
         return IngestManager(
                 self,
                 FileResource(
                     tmpdir,
                     close_transactions=self.operation_mode in [ PRESERVATION, WORM ],
-                    mode=WRITE))
+                    mode=WRITE,
+                    staging=self.staging,
+                    compression=self.compression,
+                    packing=self.packing,
+                    durability=self.durability))
 
     def ingest(self, resource : FileResource):
+        with scheduling.operation(INGEST):
+            self._ingest(resource)
+
+    def _ingest(self, resource : FileResource):
         if self.mode != READ_WRITE:
             raise Exception('Archive is not in read-write mode')
 
         target_dir = self._resolve(resource.resource_id)
         target_dir.parent.mkdir(parents=True, exist_ok=True)
 
-        if target_dir.parent.stat().st_dev != resource.path.stat().st_dev:
-            tmp_dir = self._resolve(resource.resource_id).parent.joinpath(f'tmp-{str(uuid7())}')
-            move(resource.path, tmp_dir)
-            resource.path = tmp_dir
+        if self.durability != NONE:
+            sync_tree(resource.path)
+
+        with FileLock(target_dir.parent.joinpath(f'{target_dir.name}.lock')):
+            if target_dir.exists():
+                raise Exception(f"Resource already exists: {resource.resource_id}")
 
-        move(resource.path, target_dir)
+            transfer(resource.path, target_dir)
 
-        with self.root_dir.joinpath('resources.txt').open(mode='a') as f:
-            # TODO: lock file
+        if self.durability != NONE:
+            # including any newly created intermediate directories
+            for d in target_dir.relative_to(self.root_dir).parents:
+                sync_dir(self.root_dir.joinpath(d))
+
+        # resources.txt is replaced on delete, so the lock is a file of its own
+        with FileLock(self.root_dir.joinpath('resources.lock')), self.root_dir.joinpath('resources.txt').open(mode='a') as f:
             f.write(f"{resource.resource_id}\n")
 
-    def serialize(self, resource_id: str) -> Iterable[bytes]:
-        raise Exception('Not implemented')
+            if self.durability != NONE:
+                f.flush()
+                fsync(f.fileno())
+
+        position = self.logger.log(resource.resource_id, 'ingest')
+
+        if self.catalog:
+            self.catalog.update(resource, position=position)
+
+    def delete(self, resource_id : str):
+        # only dynamic archives, e.g cache tiers, ever remove resources
+        if self.mode != READ_WRITE or self.operation_mode != DYNAMIC:
+            raise Exception('Resources can only be deleted in dynamic mode')
+
+        target_dir = self._resolve(resource_id)
+        deleted_dir = target_dir.parent.joinpath(f'{target_dir.name}-deleted-{uuid4()}')
+
+        with FileLock(target_dir.parent.joinpath(f'{target_dir.name}.lock')) as lock:
+            if not target_dir.exists():
+                raise Exception(f"Resource not found: {resource_id}")
+
+            target_dir.rename(deleted_dir)
+
+            # writers that wait on it find the resource gone
+            lock.path.unlink()
+
+        if self.durability != NONE:
+            sync_dir(target_dir.parent)
+
+        # replaced rather than rewritten in place, readers do not take the
+        # lock and see either the old or the new list
+        with FileLock(self.root_dir.joinpath('resources.lock')):
+            resource_ids = [ x for x in self.root_dir.joinpath('resources.txt').read_text().splitlines() if x != resource_id ]
+            write_atomic(self.root_dir.joinpath('resources.txt'), ''.join(f'{x}\n' for x in resource_ids), sync=self.durability != NONE)
+
+        rmtree(deleted_dir)
+        position = self.logger.log(resource_id, 'delete')
+
+        if self.catalog:
+            self.catalog.delete(resource_id, position=position)
+
+    def serialize(self, resource_id: str) -> BytesIO:
+        return self.get(resource_id).serialize()
+
+    def compact(self, resource_id : str, min_instances : int = 2) -> str:
+        return self.get(resource_id, mode=WRITE).compact(min_instances=min_instances)
+
+    def find(self, checksum : str) -> list:
+        # catalog lookups: files by checksum, files changed since (epoch or
+        # ISO 8601), optionally only for path, and usage per resource
+        return self._catalog().find(checksum)
+
+    def changed(self, since, path : str = None) -> list:
+        return self._catalog().changed(_timestamp(since), path=path)
+
+    def usage(self, resource_ids : Iterable[str] = None) -> dict:
+        return self._catalog().usage(resource_ids)
+
+    def upload(self, resource_id : str, path : str, size : int, checksum : str = None) -> UploadSession:
+        if self.mode != READ_WRITE:
+            raise Exception('Archive is not in read-write mode')
+
+        if not self.exists(resource_id):
+            raise Exception(f"No such resource: {resource_id}")
+
+        return UploadSession.create(self.staging.joinpath('_uploads'), resource_id, safe_path(path), size, checksum=checksum)
+
+    def get_upload(self, session_id : str) -> UploadSession:
+        return UploadSession(self.staging.joinpath('_uploads', Path(session_id).name))
+
+    def read_many(self, items : Iterable, mode : str = READ_BINARY) -> Iterable:
+        if mode not in [ READ, READ_BINARY ]:
+            raise Exception(f"Invalid mode: {mode}")
+
+        for resource_id, path, resource in self._resolve_many(items):
+            yield resource_id, path, resource.read(path, mode)
+
+    def serialize_many(self, items : Iterable, as_iter=False, buffer_size=10*1024) -> Union[BytesIO,Iterable[bytes]]:
+        # tar stream with one '<resource_id>/<path>' member per found file
+        import tarfile
+
+        def w(q):
+            f = qopen(q, buffering=buffer_size, timeout=600)
+
+            try:
+                with tarfile.open(fileobj=f, mode='w|') as t:
+                    for resource_id, path, resource in self._resolve_many(items):
+                        # members are always the original, uncompressed, bytes
+                        info = tarfile.TarInfo(f'{resource_id}/{path}')
+                        info.size = resource._entry(path)['size']
+                        info.mtime = int(stat(resource._resolve(path)).st_mtime)
+
+                        with resource.open(path, READ_BINARY) as f:
+                            t.addfile(info, f)
+            except Exception as e:
+                q.put(e)
+            finally:
+                f.close()
+
+        def i():
+            q = Queue(maxsize=10)
+            Thread(target=w, args=(q,), daemon=True).start()
+
+            while (b := q.get()) is not None:
+                if isinstance(b, Exception):
+                    raise b
+
+                yield b
+
+        return i() if as_iter else iopen(i(), mode='rb')
 
     def exists(self, resource_id : str) -> bool:
         return self._resolve(resource_id).exists()
 
-    def events(self, start=None) -> Iterable:
-        # TODO: optimize
-        e = self.root_dir.joinpath("log.jsonl").read_text().splitlines()
+    def scan(self, workers : int = None, fields : Iterable[str] = None, chunk_size : int = 100) -> Iterable[dict]:
+        # Manifests of all resources, in resources.txt order. Chunks of
+        # resource ids are loaded in a process pool with at most two chunks
+        # per worker in flight, so memory use is bounded. Scans are
+        # maintenance I/O, the workers share the limits of this process.
+        workers = workers or cpu_count()
+        chunks = self._chunks(chunk_size)
 
-        for l in e:
-            ts, ref, event = l.split('\t')
-            
-            if start and ts <= str(start):
-                continue
+        if workers == 1:
+            for chunk in chunks:
+                yield from _scan(self.root_dir, self.staging, chunk, fields)
+
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
 
-            yield { "timestamp": ts, "ref": ref, "event": event }
+        with ProcessPoolExecutor(max_workers=workers, initializer=scheduling.configure, initargs=(scheduling.limits(workers),)) as pool:
+            pending = deque()
+
+            for chunk in chunks:
+                pending.append(pool.submit(_scan, self.root_dir, self.staging, chunk, fields))
+
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
+
+    def events(self, start=None, position : int = 0, listen : bool = False) -> Iterable:
+        # Events after the byte position in log.jsonl and, optionally, the
+        # timestamp start (epoch or ISO 8601). Every event carries the
+        # position right after it, to be used as a checkpoint.
+        # With listen, new events are streamed as they are logged.
+        if listen:
+            yield from self.event_stream().listen(start=start, position=position)
+
+            return
+
+        start = _timestamp(start) if start else None
+
+        for event in _read_events(self.root_dir.joinpath('log.jsonl'), position):
+            if not start or event['timestamp'] > start:
+                yield event
+
+    def event_stream(self) -> EventStream:
+        # shared by all subscribers in this process
+        with self._stream_lock:
+            if self._stream is None:
+                self._stream = EventStream(self.root_dir.joinpath('log.jsonl'))
+                self.logger.listeners.append(self._stream.notify)
+
+        return self._stream
 
     #def operation_mode(self) -> str:
     #    return self.config['operation_mode']
@@ -525,9 +1286,43 @@ class FileArchive:
     def json(self, resource_id: str) -> dict:
         return self.get(resource_id).json()
 
+    def version(self, resource_id: str) -> str:
+        # cheap version lookup that does not load any instances
+        return loads(self._resolve(resource_id).joinpath('resource.json').read_text())['version']
+
+    def _catalog(self) -> Catalog:
+        if not self.catalog:
+            raise Exception('Catalog is not enabled')
+
+        return self.catalog
+
     def _new_id(self) -> str:
         return str(uuid7())
 
+    def _chunks(self, chunk_size : int) -> Iterable[list]:
+        with self.root_dir.joinpath('resources.txt').open() as f:
+            lines = (l.strip() for l in f)
+
+            while chunk := [ x for x in islice(lines, chunk_size) if x ]:
+                yield chunk
+
+    def _resolve_many(self, items : Iterable) -> Iterable:
+        # group (resource_id, path) pairs so that every resource is loaded
+        # only once, missing resources and files are skipped
+        grouped = {}
+        for resource_id, path in items:
+            grouped.setdefault(resource_id, []).append(path)
+
+        for resource_id, paths in grouped.items():
+            if not self.exists(resource_id):
+                continue
+
+            resource = self.get(resource_id)
+
+            for path in paths:
+                if resource.exists(path):
+                    yield resource_id, path, resource
+
     def _resolve(self, resource_id, filename : str = None, instance_id: str = None) -> Path:
         resource_path = self.root_dir.joinpath(*split_path(resource_id))
 
@@ -569,3 +1364,44 @@ class FileArchive:
     
     def __str__(self):
         return f"<FileArchive @ {self.root_dir }>"
+
+def _timestamp(t) -> float:
+    try:
+        return float(t)
+    except ValueError:
+        return datetime.fromisoformat(t.replace('Z', '+00:00')).timestamp()
+
+def _read_events(filename : Path, position : int = 0) -> Iterable[dict]:
+    # every event carries the position right after it
+    with open(filename, 'rb') as f:
+        f.seek(position)
+
+        for l in f:
+            # skip a line that is still being written
+            if not l.endswith(b'\n'):
+                break
+
+            position += len(l)
+            event = loads(l)
+            event['position'] = position
+
+            yield event
+
+def _scan(root_dir : Path, staging : Path, resource_ids : list, fields : Iterable[str]) -> list:
+    # runs in a worker process, or in process with a single worker
+    archive = FileArchive(root_dir, staging=staging)
+    ret = []
+
+    with scheduling.tagged(MAINTENANCE), scheduling.operation():
+        for resource_id in resource_ids:
+            if not archive.exists(resource_id):
+                continue
+
+            resource = archive.get(resource_id)
+            ret.append(resource.manifest(fields=fields))
+
+            if scheduling.scheduler:
+                # the metadata that was read
+                scheduling.throttle(stat(join(resource.path, 'resource.json')).st_size + sum(stat(join(resource.path, 'instances', x, 'instance.json')).st_size for x in resource.instances))
+
+    return ret
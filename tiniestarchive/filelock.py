@@ -0,0 +1,27 @@
+from fcntl import flock, LOCK_EX, LOCK_UN
+from pathlib import Path
+
+# Advisory, exclusive and reentrant (per object) lock on a file. Readers
+# never take locks, so only writers wait for each other.
+class FileLock(object):
+    def __init__(self, path : str):
+        self.path = Path(path)
+        self.depth = 0
+        self.f = None
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.f = self.path.open('a')
+            flock(self.f, LOCK_EX)
+
+        self.depth += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+
+        if self.depth == 0:
+            flock(self.f, LOCK_UN)
+            self.f.close()
+            self.f = None
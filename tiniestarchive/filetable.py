@@ -0,0 +1,357 @@
+from array import array
+from collections.abc import Mapping
+from os.path import join
+from typing import Iterable
+
+# A compact table of the current files of a resource, for resources with
+# millions of files. Rather than one dict per file, paths are kept in one
+# utf-8 blob, md5 checksums and file ids as raw bytes and the rest in typed
+# arrays, with instance ids, packs and encodings interned as small integers.
+# Columns that only some resources use (packs, compression) are allocated
+# on first use. Paths, and checksums, are looked up through open addressing
+# hash indexes.
+#
+# The table is a read-only mapping of path to location, i.e
+# 'instances/<instance_id>/data/<path>' or 'instances/<instance_id>/<pack>',
+# and entry(path) rebuilds the instance.json entry of a file.
+
+_EMPTY = bytes(16)
+_COLUMNS = { 'id', 'path', 'size', 'checksum', 'encoding', 'stored_size', 'stored_checksum', 'pack', 'offset' }
+
+# optional columns, typecode (None for 16 byte values) and default
+_OPTIONAL = { 'encoding': ('b', -1), 'stored_size': ('q', -1), 'stored_checksum': (None, _EMPTY), 'pack': ('i', -1), 'offset': ('q', -1) }
+
+class FileTable(Mapping):
+    def __init__(self, size : int = 0):
+        self.instance_ids, self.packs, self.encodings = [], [], []
+        self._interned = ({}, {}, {})
+
+        self._blob, self._start = bytearray(), array('Q', [ 0 ])
+        self._instance, self._size = array('i'), array('q')
+        self._id, self._checksum = bytearray(), bytearray()
+        self._optional = {}
+
+        # anything that does not fit the columns, by row
+        self._extra = {}
+
+        self._index = _index(size)
+        self._checksums = None
+        self._live = 0
+
+    def add(self, instance_id : str, entry : dict):
+        self.update(instance_id, [ entry ])
+
+    def update(self, instance_id : str, entries : Iterable[dict]):
+        # later entries for the same path replace earlier ones, this is the
+        # hot path when loading a resource so lookups are bound locally
+        n = self._intern(0, self.instance_ids, instance_id)
+        find, intern, extras, optional = self._find, self._intern, self._extra, self._optional
+        instance, size, ids, checksum = self._instance, self._size, self._id, self._checksum
+        self._checksums = None
+
+        for entry in entries:
+            key = entry['path'].encode('utf-8')
+            h = hash(key)
+            row = find(key, h)
+            extra = {}
+
+            if entry.get('status', None) == 'deleted':
+                if row is not None and instance[row] >= 0:
+                    instance[row] = -1
+                    extras.pop(row, None)
+                    self._live -= 1
+
+                continue
+
+            values = (
+                n,
+                entry.get('size', -1),
+                _uuid(entry.get('id', None), 'id', extra),
+                _md5(entry.get('checksum', None), 'checksum', extra))
+
+            if entry.keys() <= { 'id', 'path', 'size', 'checksum' }:
+                options = None
+            else:
+                options = {
+                    'encoding': intern(2, self.encodings, entry['encoding']) if 'encoding' in entry else -1,
+                    'stored_size': entry.get('stored_size', -1),
+                    'stored_checksum': _md5(entry.get('stored_checksum', None), 'stored_checksum', extra),
+                    'pack': intern(1, self.packs, entry['pack']) if 'pack' in entry else -1,
+                    'offset': entry.get('offset', -1) }
+
+                extra.update({ k:v for k,v in entry.items() if k not in _COLUMNS })
+
+            if row is None:
+                row = len(instance)
+                self._blob += key
+                self._start.append(len(self._blob))
+                self._insert(row, h)
+
+                instance.append(values[0])
+                size.append(values[1])
+                ids += values[2]
+                checksum += values[3]
+                self._live += 1
+            else:
+                if instance[row] < 0:
+                    self._live += 1
+
+                instance[row], size[row] = values[:2]
+                ids[row*16:row*16 + 16] = values[2]
+                checksum[row*16:row*16 + 16] = values[3]
+                extras.pop(row, None)
+
+            if options or optional:
+                self._set_optional(row, options or {})
+
+            if extra:
+                extras[row] = extra
+
+    def entry(self, path : str) -> dict:
+        row = self._row(path)
+        ret = {}
+
+        if self._id[row*16:row*16 + 16] != _EMPTY:
+            h = self._id[row*16:row*16 + 16].hex()
+            ret['id'] = f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+        ret['path'] = path
+
+        if self._size[row] >= 0:
+            ret['size'] = self._size[row]
+
+        if self._checksum[row*16:row*16 + 16] != _EMPTY:
+            ret['checksum'] = 'md5:' + self._checksum[row*16:row*16 + 16].hex()
+
+        for name in _OPTIONAL:
+            if (value := self._get_optional(row, name)) is None:
+                continue
+
+            if name == 'encoding':
+                value = self.encodings[value]
+            elif name == 'stored_checksum':
+                value = 'md5:' + value.hex()
+            elif name == 'pack':
+                value = self.packs[value]
+
+            ret[name] = value
+
+        ret.update(self._extra.get(row, {}))
+
+        return ret
+
+    def instance_id(self, path : str) -> str:
+        return self.instance_ids[self._instance[self._row(path)]]
+
+    @property
+    def checksums(self) -> Mapping:
+        # checksum -> path of the current files, indexed on first use
+        if self._checksums is None:
+            self._checksums = _Checksums(self)
+
+        return self._checksums
+
+    def __getitem__(self, path : str) -> str:
+        row = self._row(path)
+        instance_id = self.instance_ids[self._instance[row]]
+
+        if (pack := self._get_optional(row, 'pack')) is not None:
+            return join('instances', instance_id, self.packs[pack])
+
+        return join('instances', instance_id, 'data', path)
+
+    def __contains__(self, path) -> bool:
+        row = self._find(path.encode('utf-8')) if isinstance(path, str) else None
+
+        return row is not None and self._instance[row] >= 0
+
+    def __iter__(self):
+        for row in range(len(self._instance)):
+            if self._instance[row] >= 0:
+                yield self._path(row)
+
+    def __len__(self) -> int:
+        return self._live
+
+    def _row(self, path : str) -> int:
+        row = self._find(path.encode('utf-8'))
+
+        if row is None or self._instance[row] < 0:
+            raise KeyError(path)
+
+        return row
+
+    def _path(self, row : int) -> str:
+        return self._blob[self._start[row]:self._start[row + 1]].decode('utf-8')
+
+    def _get_optional(self, row : int, name : str):
+        if (column := self._optional.get(name, None)) is None:
+            return None
+
+        if _OPTIONAL[name][0] is None:
+            value = bytes(column[row*16:row*16 + 16])
+
+            return value if value != _EMPTY else None
+
+        return column[row] if column[row] >= 0 else None
+
+    def _set_optional(self, row : int, values : dict):
+        # allocated columns always have one value per row, i.e are allocated
+        # for every row there is, the row being set need not be the last one
+        rows = len(self._instance)
+
+        for name, (typecode, default) in _OPTIONAL.items():
+            value = values.get(name, default)
+
+            if (column := self._optional.get(name, None)) is None:
+                if value == default:
+                    continue
+
+                column = self._optional[name] = bytearray(16 * rows) if typecode is None else array(typecode, [ -1 ]) * rows
+
+            if typecode is None:
+                column[row*16:row*16 + 16] = value
+            elif row == len(column):
+                column.append(value)
+            else:
+                column[row] = value
+
+    def _find(self, key : bytes, h : int = None) -> int:
+        h = hash(key) if h is None else h
+        index, blob, start = self._index, self._blob, self._start
+        mask = len(index) - 1
+        i = h & mask
+
+        while (row := index[i]) >= 0:
+            if blob[start[row]:start[row + 1]] == key:
+                return row
+
+            i = (i + 1) & mask
+
+        return None
+
+    def _insert(self, row : int, h : int):
+        # keep the index at most half full
+        if 2 * (row + 1) > len(self._index):
+            self._index = _index(row + 1)
+
+            for r in range(row):
+                _slot(self._index, r, hash(bytes(self._blob[self._start[r]:self._start[r + 1]])))
+
+        _slot(self._index, row, h)
+
+    def _intern(self, n : int, values : list, value : str) -> int:
+        if value not in self._interned[n]:
+            self._interned[n][value] = len(values)
+            values.append(value)
+
+        return self._interned[n][value]
+
+class _Checksums(Mapping):
+    # checksum -> path, as an open addressing hash index over the checksum
+    # column, other checksums (if any) in a plain dict
+    def __init__(self, table : FileTable):
+        self.table = table
+        self._other = {}
+
+        rows = [ row for row in range(len(table._instance)) if table._instance[row] >= 0 ]
+        self._index = _index(len(rows))
+
+        for row in rows:
+            key = bytes(table._checksum[row*16:row*16 + 16])
+
+            if key != _EMPTY:
+                _slot(self._index, row, hash(key))
+            elif 'checksum' in table._extra.get(row, {}):
+                self._other[table._extra[row]['checksum']] = row
+
+    def _find(self, checksum : str) -> int:
+        if not isinstance(checksum, str):
+            return None
+
+        if checksum in self._other:
+            return self._other[checksum]
+
+        try:
+            key = _md5(checksum, 'checksum', None)
+        except ValueError:
+            return None
+
+        mask = len(self._index) - 1
+        i = hash(key) & mask
+
+        while (row := self._index[i]) >= 0:
+            if self.table._checksum[row*16:row*16 + 16] == key:
+                return row
+
+            i = (i + 1) & mask
+
+        return None
+
+    def __getitem__(self, checksum : str) -> str:
+        if (row := self._find(checksum)) is None:
+            raise KeyError(checksum)
+
+        return self.table._path(row)
+
+    def __contains__(self, checksum) -> bool:
+        return self._find(checksum) is not None
+
+    def __iter__(self):
+        table = self.table
+
+        for row in range(len(table._instance)):
+            if table._instance[row] >= 0:
+                if table._checksum[row*16:row*16 + 16] != _EMPTY:
+                    yield 'md5:' + table._checksum[row*16:row*16 + 16].hex()
+                elif 'checksum' in table._extra.get(row, {}):
+                    yield table._extra[row]['checksum']
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+def _index(size : int) -> array:
+    # a power of two, at least twice the size
+    n = 1024
+    while n < 2 * size:
+        n *= 2
+
+    return array('i', [ -1 ]) * n
+
+def _slot(index : array, row : int, h : int):
+    mask = len(index) - 1
+    i = h & mask
+
+    while index[i] >= 0:
+        i = (i + 1) & mask
+
+    index[i] = row
+
+def _md5(checksum : str, key : str, extra : dict) -> bytes:
+    # 'md5:<hex>' as 16 bytes, anything else is kept as is in extra
+    if checksum and len(checksum) == 36 and checksum.startswith('md5:') and checksum == checksum.lower():
+        try:
+            return bytes.fromhex(checksum[4:])
+        except ValueError:
+            pass
+
+    if extra is None:
+        raise ValueError(checksum)
+
+    if checksum is not None:
+        extra[key] = checksum
+
+    return _EMPTY
+
+def _uuid(value : str, key : str, extra : dict) -> bytes:
+    # canonical (lower case, dashed) uuids as 16 bytes
+    if value and len(value) == 36 and value[8] == value[13] == value[18] == value[23] == '-' and value == value.lower():
+        try:
+            return bytes.fromhex(value.replace('-', ''))
+        except ValueError:
+            pass
+
+    if value is not None:
+        extra[key] = value
+
+    return _EMPTY
@@ -1,28 +1,94 @@
-from json import loads
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from json import dumps, loads
 from io import BufferedIOBase, BytesIO
+from os import rename, stat
+from pathlib import Path
+from threading import Lock
+from time import sleep
 from typing import Iterable, Union
 from urllib.parse import urljoin
 from uuid import UUID
 from requests import Session
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
 
 from tiniestarchive import Archive,Instance,Resource,FileInstance,PRESERVATION, WORM, READ, WRITE, READ_BINARY
 from tiniestarchive.commitmanager import CommitManager
-from tiniestarchive.utils import chunker
+from tiniestarchive.utils import chunker, write_atomic
 
 class HttpResource(Resource):
-    def __init__(self, url, archive=None, auth = None, mode=READ):
+    def __init__(self, url, archive=None, auth = None, mode=READ, page_size=10000, retries=10):
         self.url = url
         self.archive = archive
         self.auth = auth
         self.mode = mode
+        self.page_size = page_size
+        self.retries = retries
         self.session = Session()
+        self._manifests = {}
+        self._files = None
 
-        self.config = loads(self._get(self.url).text)
+        self.config = self.manifest(fields=[ 'summary' ])
         self.resource_id = self.config['id']
 
-    def serialize(self) -> BytesIO:
-        r = self._get(urljoin(self.url, '_serialize'), stream=True)
-        r.raw.decode_stream = True
+    def manifest(self, fields : list = None, cursor : str = None, limit : int = None) -> dict:
+        params = { k:v for k,v in { 'fields': ','.join(fields) if fields else None, 'cursor': cursor, 'limit': limit }.items() if v is not None }
+        key = tuple(sorted(params.items()))
+        etag, cached = self._manifests.get(key, (None, None))
+
+        r = self._get(self.url, params=params, headers={ 'If-None-Match': etag } if etag else {})
+
+        if r.status_code == 304:
+            return cached
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to get manifest: {r.status_code}: {r.text}")
+
+        ret = loads(r.text)
+
+        # later pages are only read once per version, so only the first page
+        # is kept, one per combination of fields and limit
+        if cursor is None:
+            self._manifests[key] = (r.headers.get('ETag'), ret)
+
+        return ret
+
+    def json(self) -> dict:
+        return self.manifest()
+
+    @property
+    def files(self) -> dict:
+        # unchanged first page means the whole file list is unchanged, paging
+        # starts over if the resource changes meanwhile, a few times at most
+        for _ in range(self.retries):
+            m = self.manifest(fields=[ 'files' ], limit=self.page_size)
+
+            if self._files and self._files[0] == m['version']:
+                return self._files[1]
+
+            files, version = dict(m['files']), m['version']
+            while 'next' in m and m['version'] == version:
+                m = self.manifest(fields=[ 'files' ], cursor=m['next'], limit=self.page_size)
+                files.update(m['files'])
+
+            if m['version'] == version:
+                self._files = (version, files)
+
+                return files
+
+        raise Exception(f"Resource changed while paging files: {self.resource_id}")
+
+    def exists(self, path : str) -> bool:
+        return path in self.files
+
+    def serialize(self, instance_id : str = None) -> BytesIO:
+        r = self._get(urljoin(self.url, '_serialize'), params={ 'instance_id': instance_id } if instance_id else {}, stream=True)
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to serialize resource: {r.status_code}: {r.text}")
+
+        r.raw.decode_content = True
 
         return r.raw
 
@@ -32,7 +98,11 @@ class HttpResource(Resource):
 
         url = self._resolve(path)
         r = self._get(url, stream=True)
-        r.raw.decode_stream = True
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to open {path}: {r.status_code}: {r.text}")
+
+        r.raw.decode_content = True
 
         return r.raw
 
@@ -44,13 +114,122 @@ class HttpResource(Resource):
     #    r = self._post(urljoin(self.url, '_add'), files=files)
 
     def update(self, instance : Instance):
+        # only the files the server does not already have are sent, plain
+        # files that is, compressed files are always sent as they are
+        entries = [ { k:e[k] for k in [ 'path', 'checksum', 'size' ] } for e in (instance[x] for x in instance) if e.keys() >= { 'checksum', 'size' } and not e.keys() & { 'status', 'encoding', 'pack' } ]
+        have = []
+
+        if entries:
+            r = self._post(urljoin(self.url, '_have'), json=entries)
+
+            # servers without negotiation get everything
+            if r.status_code == 200:
+                have = loads(r.text)
+
         r = self._post(
             urljoin(self.url, '_update'),
-            files = { 'file': instance.serialize() })
+            files = { 'file': instance.serialize(exclude=have) })
         
         if r.status_code != 200:
             raise Exception(f"Failed to update resource: {r.status_code}: {r.text}")
 
+    def upload(self, filename, path : str = None, session_id : str = None, chunk_size : int = 16*1024*1024, workers : int = 4) -> str:
+        # Resumable upload of a single file into a new transaction, in
+        # parallel chunks. Pass the session id of a failed upload to only
+        # send the chunks the server does not already have.
+        path = path or Path(filename).name
+        size = stat(filename).st_size
+
+        if not session_id:
+            # the checksum of the whole file is verified on commit
+            cs = md5()
+            with open(filename, 'rb') as f:
+                while b := f.read(1024*1024):
+                    cs.update(b)
+
+            r = self._post(urljoin(self.url, '_uploads'), json={ 'path': path, 'size': size, 'checksum': f'md5:{cs.hexdigest()}' })
+
+            if r.status_code != 200:
+                raise Exception(f"Failed to create upload: {r.status_code}: {r.text}")
+
+            session_id = loads(r.text)['id']
+
+        session_url = urljoin(self.url, f'_uploads/{session_id}')
+        r = self._get(session_url)
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to get upload: {r.status_code}: {r.text}")
+
+        ranges = loads(r.text)['ranges']
+
+        def put(offset):
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                data = f.read(chunk_size)
+
+            r = self.session.put(
+                    session_url,
+                    auth=self.auth,
+                    params={ 'offset': offset },
+                    headers={ 'X-Checksum': f'md5:{md5(data).hexdigest()}' },
+                    data=data)
+
+            if r.status_code != 200:
+                raise Exception(f"Failed to upload chunk at {offset}: {r.status_code}: {r.text}")
+
+        missing = [ offset for offset in range(0, size, chunk_size) if not any(start <= offset and min(offset + chunk_size, size) <= end for start, end in ranges) ]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(put, missing))
+
+        r = self._post(urljoin(session_url + '/', '_commit'))
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to commit upload: {r.status_code}: {r.text}")
+
+        return session_id
+
+    def download(self, path, filename, chunk_size : int = 16*1024*1024, workers : int = 4):
+        # Parallel ranged download. Progress is kept in '<filename>.part.json'
+        # so that an interrupted download resumes where it left off.
+        url = self._resolve(path)
+        r = self._get(url, headers={ 'Range': 'bytes=0-0' })
+
+        if r.status_code not in [ 206, 416 ]:
+            raise Exception(f"Failed to download {path}: {r.status_code}: {r.text}")
+
+        size = int(r.headers['Content-Range'].split('/')[-1])
+        part, progress = Path(f'{filename}.part'), Path(f'{filename}.part.json')
+        done = set()
+
+        if part.exists() and progress.exists() and loads(progress.read_text())['chunk_size'] == chunk_size:
+            done = set(loads(progress.read_text())['done'])
+        else:
+            with part.open('wb') as f:
+                f.truncate(size)
+
+        lock = Lock()
+
+        def get(offset):
+            r = self._get(url, headers={ 'Range': f'bytes={offset}-{min(offset + chunk_size, size) - 1}' })
+
+            if r.status_code != 206:
+                raise Exception(f"Failed to download {path} at {offset}: {r.status_code}: {r.text}")
+
+            with part.open('r+b') as f:
+                f.seek(offset)
+                f.write(r.content)
+
+            with lock:
+                done.add(offset)
+                write_atomic(progress, dumps({ 'chunk_size': chunk_size, 'done': sorted(done) }))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(get, [ offset for offset in range(0, size, chunk_size) if offset not in done ]))
+
+        rename(part, filename)
+        progress.unlink(missing_ok=True)
+
     def transaction(self):
         return CommitManager(
                     self,
@@ -67,7 +246,7 @@ class HttpResource(Resource):
                 headers=headers,
                 stream=stream)
 
-    def _post(self, url, params={}, headers={}, files=None, data=None, stream=False):
+    def _post(self, url, params={}, headers={}, files=None, data=None, json=None, stream=False):
         return self.session.post(
                 url,
                 auth=self.auth, 
@@ -75,6 +254,7 @@ class HttpResource(Resource):
                 headers=headers,
                 files=files,
                 data=data,
+                json=json,
                 stream=stream)
 
     #def __repr__(self):
@@ -85,33 +265,134 @@ class HttpResource(Resource):
 
 
 class HttpArchive(Archive):
-    def __init__(self, url):
+    def __init__(self, url, auth = None):
         self.url = url
+        self.auth = auth
+        self.session = Session()
+
+    @property
+    def operation_mode(self) -> str:
+        r = self.session.get(self.url, auth=self.auth)
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to get archive: {r.status_code}: {r.text}")
+
+        return loads(r.text)['operation_mode']
 
     def new(self) -> HttpResource:
         raise Exception('Not implemented')
+
+    def get(self, resource_id : str, mode : str = READ) -> HttpResource:
+        return HttpResource(urljoin(self.url, f'{resource_id}/'), archive=self, auth=self.auth, mode=mode)
     
     def serialize(self, resource_id: str) -> BytesIO:
-        raise Exception('Not implemented')
+        return self.get(resource_id).serialize()
+
+    def ingest(self, resource):
+        # any resource that can serialize itself, e.g a FileResource
+        r = self.session.post(urljoin(self.url, '_ingest'), auth=self.auth, files={ 'file': resource.serialize() })
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to ingest resource: {r.status_code}: {r.text}")
 
     def open(self, resource_id: str, filename : str, instance_id : str = None, mode='r') -> BufferedIOBase:
         if mode not in [ READ, READ_BINARY ]:
             raise Exception(f"Invalid mode: '{mode}'")
 
-        return self._resolve(resource_id, instance_id = instance_id, filename = filename).open(mode)
+        if instance_id:
+            raise Exception('Files of a given instance cannot be opened over HTTP')
+
+        return self.get(resource_id).open(filename, mode=mode)
 
     def read(self, resource_id: str, filename : str, mode='r') -> Union[str,bytes]:
         with self.open(resource_id, filename, mode=mode) as f:
             return f.read()
 
+    def read_many(self, items : Iterable, mode=READ_BINARY) -> Iterable:
+        if mode not in [ READ, READ_BINARY ]:
+            raise Exception(f"Invalid mode: '{mode}'")
+
+        r = self.session.post(urljoin(self.url, '_read'), auth=self.auth, json=[ list(x) for x in items ], stream=True)
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to read files: {r.status_code}: {r.text}")
+
+        r.raw.decode_content = True
+
+        with tarfile.open(fileobj=r.raw, mode='r|') as t:
+            for member in t:
+                resource_id, path = member.name.split('/', 1)
+                data = t.extractfile(member).read()
+
+                yield resource_id, path, data if mode == READ_BINARY else data.decode('utf-8')
+
     def exists(self, resource_id : str) -> bool:
-        return self._resolve(resource_id).exists()
+        r = self.session.get(urljoin(self.url, f'{resource_id}/'), auth=self.auth, params={ 'fields': 'summary' })
+
+        if r.status_code == 404:
+            return False
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to get resource: {r.status_code}: {r.text}")
+
+        return True
+
+    def events(self, start=None, position : int = 0, listen=False) -> Iterable:
+        if listen:
+            yield from self._listen(start, position)
+
+            return
+
+        params = { 'position': position }
+
+        if start:
+            params['start'] = start
+
+        r = self.session.get(urljoin(self.url, '_events'), auth=self.auth, params=params, stream=True)
 
-    def events(self, start=None, listen=False) -> Iterable:
-        ...
+        if r.status_code != 200:
+            raise Exception(f"Failed to get events: {r.status_code}: {r.text}")
+
+        for l in r.iter_lines():
+            if l:
+                yield loads(l)
+
+    def _listen(self, start, position : int) -> Iterable:
+        # Server-Sent Events, reconnecting from the last seen position
+        delay = 1
+
+        while True:
+            try:
+                params = { 'listen': 'true', 'position': position }
+
+                if start:
+                    params['start'] = start
+
+                r = self.session.get(urljoin(self.url, '_events'), auth=self.auth, params=params, stream=True, timeout=(10, 60))
+
+                if r.status_code != 200:
+                    raise Exception(f"Failed to get events: {r.status_code}: {r.text}")
+
+                data = []
+                for l in r.iter_lines(decode_unicode=True):
+                    if l.startswith('data:'):
+                        data.append(l[5:].strip())
+                    elif l == '' and data:
+                        event = loads('\n'.join(data))
+                        position, data, delay = event['position'], [], 1
+
+                        yield event
+            except (ConnectionError, Timeout, ChunkedEncodingError):
+                sleep(delay)
+                delay = min(2 * delay, 60)
 
     def __iter__(self):
-        ...
+        r = self.session.get(urljoin(self.url, '_resources'), auth=self.auth, stream=True)
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to list resources: {r.status_code}: {r.text}")
+
+        return (l.decode('utf-8') for l in r.iter_lines() if l)
 
     def __repr__(self):
         return f"<HttpArchive({self.instance_id}) @ {hex(id(self))}>"
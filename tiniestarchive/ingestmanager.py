@@ -23,4 +23,4 @@ class IngestManager(object):
         finally:
             if resource_path.exists():
                 #print(f'resource - rmtree({resource_path})', file=stderr)
-                rmtree(self.resource.path)
+                rmtree(resource_path)
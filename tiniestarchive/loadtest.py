@@ -0,0 +1,277 @@
+# Load generator for the HTTP service, e.g
+#
+#   python -m tiniestarchive.loadtest --concurrency 1,4,16,64 --duration 30
+#   python -m tiniestarchive.loadtest --mix get=80,manifest=20 --env DURABILITY=operation
+#   python -m tiniestarchive.loadtest --url http://localhost:8000/ --concurrency 8
+#
+# Unless given --url, app.py is started with uvicorn against a temporary
+# archive that is seeded with --resources resources of --files files each.
+# Every concurrency level then runs a weighted mix of operations for
+# --duration seconds, from one thread per client. HttpArchive/HttpResource
+# are the client, so client side overhead is part of the latencies, which
+# are reported per operation as p50/p95/p99 along with throughput:
+#
+#   get       - GET /{id}/{file}
+#   manifest  - GET /{id}/
+#   add       - POST /{id}/_add
+#   ingest    - POST /_ingest
+#   serialize - GET /{id}/_serialize
+#   events    - GET /_events
+
+from argparse import ArgumentParser
+from io import BytesIO
+from json import dumps
+from os import environ, urandom
+from pathlib import Path
+from random import Random
+from shutil import rmtree
+from socket import socket
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import monotonic, sleep
+from urllib.parse import urljoin
+import subprocess
+import sys
+
+from requests import get
+
+from tiniestarchive import FileResource, HttpArchive
+from tiniestarchive.__main__ import _size
+
+OPERATIONS = [ 'get', 'manifest', 'add', 'ingest', 'serialize', 'events' ]
+MIX = 'get=60,manifest=20,add=5,ingest=5,serialize=5,events=5'
+
+class Server(object):
+    # app.py in a subprocess, on a free port
+    def __init__(self, data_dir : str, app_dir : str = None, env : dict = {}, workers : int = 1):
+        self.app_dir = Path(app_dir or Path(__file__).resolve().parent.parent.joinpath('app'))
+
+        with socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+
+        self.url = f'http://127.0.0.1:{self.port}/'
+        self.process = subprocess.Popen(
+                [ sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(self.port), '--workers', str(workers) ],
+                cwd=self.app_dir,
+                env={ **environ, 'PYTHONPATH': str(Path(__file__).resolve().parent.parent), 'DATA_DIR': str(data_dir), **env },
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+
+        for _ in range(300):
+            try:
+                if get(urljoin(self.url, 'ok')).status_code == 200:
+                    return
+            except Exception:
+                if self.process.poll() is not None:
+                    raise Exception(f'Server exited with {self.process.returncode}')
+
+            sleep(0.1)
+
+        self.close()
+
+        raise Exception('Server did not start')
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+class Client(object):
+    # one per thread, since sessions are not shared between threads
+    def __init__(self, url : str, resources : dict, staging : Path, file_size : int, seed : int):
+        self.archive = HttpArchive(url)
+        self.resources = resources
+        self.staging = staging
+        self.file_size = file_size
+        self.random = Random(seed)
+        self._resources = {}
+
+    def prepare(self, operation : str):
+        # anything that should not be timed, returns the arguments
+        resource_id = self.random.choice(list(self.resources))
+
+        if operation == 'get':
+            return resource_id, self.random.choice(self.resources[resource_id])
+        elif operation == 'add':
+            # a bounded set of paths, so that resources do not grow forever
+            return resource_id, f'loadtest/{self.random.randrange(100)}', urandom(self.file_size)
+        elif operation == 'ingest':
+            return (_resource(self.staging, 1, self.file_size),)
+
+        return (resource_id,)
+
+    def get(self, resource_id, path):
+        self._resource(resource_id).read(path, mode='rb')
+
+    def manifest(self, resource_id):
+        self._resource(resource_id).manifest()
+
+    def add(self, resource_id, path, data):
+        r = self._resource(resource_id)._post(urljoin(self._resource(resource_id).url, '_add'), files=[ ('files', (path, data)) ])
+
+        if r.status_code != 200:
+            raise Exception(f"Failed to add file: {r.status_code}: {r.text}")
+
+    def ingest(self, resource):
+        try:
+            self.archive.ingest(resource)
+        finally:
+            rmtree(resource.path, ignore_errors=True)
+
+    def serialize(self, resource_id):
+        with self._resource(resource_id).serialize() as f:
+            while f.read(1024*1024):
+                pass
+
+    def events(self, resource_id):
+        for i, _ in enumerate(self.archive.events()):
+            if i == 99:
+                break
+
+    def _resource(self, resource_id):
+        if resource_id not in self._resources:
+            self._resources[resource_id] = self.archive.get(resource_id)
+
+        return self._resources[resource_id]
+
+def run(url : str, resources : dict, staging : Path, mix : dict, concurrency : int, duration : float, file_size : int) -> dict:
+    # operation -> { 'latencies': [...], 'errors': n }
+    results = { x:{ 'latencies': [], 'errors': 0 } for x in mix }
+    stop = Event()
+
+    def worker(n):
+        client = Client(url, resources, staging, file_size, n)
+        operations, weights = list(mix), list(mix.values())
+
+        while not stop.is_set():
+            operation = client.random.choices(operations, weights)[0]
+            args = client.prepare(operation)
+            t = monotonic()
+
+            try:
+                getattr(client, operation)(*args)
+                results[operation]['latencies'].append(monotonic() - t)
+            except Exception:
+                results[operation]['errors'] += 1
+
+    threads = [ Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency) ]
+
+    for t in threads:
+        t.start()
+
+    sleep(duration)
+    stop.set()
+
+    for t in threads:
+        t.join()
+
+    return results
+
+def report(results : dict, concurrency : int, duration : float) -> dict:
+    ret = { 'concurrency': concurrency, 'operations': {} }
+
+    for operation in sorted(results, key=OPERATIONS.index):
+        latencies = sorted(results[operation]['latencies'])
+        ret['operations'][operation] = {
+            'requests': len(latencies),
+            'errors': results[operation]['errors'],
+            'throughput': len(latencies) / duration,
+            **{ f'p{p}': _percentile(latencies, p) for p in [ 50, 95, 99 ] } }
+
+    ret['throughput'] = sum(x['throughput'] for x in ret['operations'].values())
+
+    return ret
+
+def seed(url : str, staging : Path, n : int, files : int, file_size : int) -> dict:
+    # resource id -> paths
+    archive, ret = HttpArchive(url), {}
+
+    for _ in range(n):
+        resource = _resource(staging, files, file_size)
+        archive.ingest(resource)
+        ret[resource.resource_id] = list(resource.files)
+        rmtree(resource.path, ignore_errors=True)
+
+    return ret
+
+def _resource(staging : Path, files : int, file_size : int) -> FileResource:
+    resource = FileResource(staging=staging)
+
+    with resource.transaction() as t:
+        for i in range(files):
+            t.add(None, path=f'data/{i:05}.bin', data=BytesIO(urandom(file_size)))
+
+    return resource
+
+def _percentile(values : list, p : int) -> float:
+    # nearest rank, in milliseconds
+    if not values:
+        return None
+
+    return 1000 * values[min(len(values) - 1, max(0, -(-p * len(values) // 100) - 1))]
+
+def _print(r : dict):
+    print(f"concurrency {r['concurrency']}: {r['throughput']:.1f} req/s")
+    print(f"  {'operation':<10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+    for operation, x in r['operations'].items():
+        latencies = ''.join(f' {x[p]:>9.1f}' if x[p] is not None else f" {'-':>9}" for p in [ 'p50', 'p95', 'p99' ])
+        print(f"  {operation:<10} {x['requests']:>9} {x['errors']:>7} {x['throughput']:>9.1f}{latencies}")
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m tiniestarchive.loadtest')
+    parser.add_argument('--url', help='an already running service, instead of starting app.py')
+    parser.add_argument('--app', help='the directory of app.py')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE for the server, e.g DURABILITY=operation')
+    parser.add_argument('--server-workers', type=int, default=1)
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated levels')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--mix', default=MIX, help='comma separated operation=weight')
+    parser.add_argument('--resources', type=int, default=20)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--file-size', type=_size, default='64K')
+    parser.add_argument('--json', action='store_true', help='one JSON report per level')
+    args = parser.parse_args(argv)
+
+    mix = { k:float(v) for k,v in (x.split('=') for x in args.mix.split(',')) }
+
+    if set(mix) - set(OPERATIONS):
+        parser.error(f"Unknown operations: {', '.join(set(mix) - set(OPERATIONS))}")
+
+    tmp = Path(mkdtemp(prefix='loadtest-'))
+    server = None
+
+    try:
+        if args.url:
+            url = args.url if args.url.endswith('/') else args.url + '/'
+        else:
+            server = Server(tmp.joinpath('archive'), app_dir=args.app, env=dict(x.split('=', 1) for x in args.env), workers=args.server_workers)
+            url = server.url
+
+        staging = tmp.joinpath('staging')
+        staging.mkdir()
+
+        print(f'Seeding {args.resources} resources at {url}', file=sys.stderr)
+        resources = seed(url, staging, args.resources, args.files, args.file_size)
+        reports = []
+
+        for concurrency in [ int(x) for x in args.concurrency.split(',') ]:
+            r = report(run(url, resources, staging, mix, concurrency, args.duration, args.file_size), concurrency, args.duration)
+            reports.append(r)
+
+            print(dumps(r)) if args.json else _print(r)
+            sys.stdout.flush()
+
+        # the first level that adds less than 10% throughput over the previous
+        saturated = next((b for a, b in zip(reports, reports[1:]) if b['throughput'] < 1.1 * a['throughput']), None)
+
+        if saturated and not args.json:
+            print(f"saturated at concurrency {saturated['concurrency']}")
+    finally:
+        if server:
+            server.close()
+
+        rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,197 @@
-from tiniestarchive import Archive,Resource
+from concurrent.futures import ThreadPoolExecutor
+from sys import stderr
+from threading import Event, Lock, Thread
+from time import monotonic
 
+from tiniestarchive import Archive,Resource,DELETED,DYNAMIC
+from tiniestarchive.scheduling import MAINTENANCE, tagged
+
+# Archives in order of preference, i.e the fastest first. Given capacity
+# budgets (in bytes, None for no budget), the archives are tiers: the last
+# archive holds the authoritative copy, and resources that are read often
+# are copied (promoted) to the fastest tier with a budget that has room for
+# them, removing (demoting) resources that are read less often. Tiers with a
+# budget are caches, so they have to be dynamic FileArchives.
+#
+# Access frequency is a count per resource that halves every `half_life`
+# seconds, resources are promoted once it reaches `promote_after`. Whole
+# resources are promoted, as that is what archives ingest and delete. Copies
+# are made in the background by `workers` threads, and accesses are not
+# held up by promotions, so a budget may be exceeded by a resource per
+# worker while a copy is made, and a read of a resource that is demoted
+# meanwhile fails. Copies are checked against the version of the
+# authoritative copy before they are read, and dropped if they are out of
+# date, as refresh() does for all copies, see start().
 class MultiArchive(Archive):
-    def __init__(self, archives : list):
+    def __init__(self, archives : list, capacity : list = None, promote_after : float = 3, half_life : float = 3600, workers : int = 2):
         self.archives = archives
+        self.capacity = capacity or [ None ] * len(archives)
+        self.promote_after = promote_after
+        self.half_life = half_life
+        self.workers = workers
+
+        if len(self.capacity) != len(archives) or self.capacity[-1] is not None:
+            raise Exception('Every archive but the last may have a capacity')
+
+        for a, c in zip(archives, self.capacity):
+            if c is not None and getattr(a, 'operation_mode', None) != DYNAMIC:
+                raise Exception(f'Tiers with a capacity must be dynamic FileArchives: {a}')
+
+        # resource id -> (count, time) and, per tier with a budget, resource
+        # id -> bytes
+        self.heat = {}
+        self.usage = [ { x:_size(a, x) for x in a if a.exists(x) } if c is not None else None for a, c in zip(archives, self.capacity) ]
+
+        self._pool = ThreadPoolExecutor(max_workers=workers) if any(c is not None for c in self.capacity) else None
+        self._pending = set()
+        self._lock = Lock()
+        self._stopped = Event()
 
     def get(self, resource_id : str):
-        return MultiResource([ a.get(resource_id) for a in self.archives if a.exists(resource_id) ])
+        if not self._pool:
+            return MultiResource([ a.get(resource_id) for a in self.archives if a.exists(resource_id) ])
+
+        # the fastest copy that is up to date, tiers hold complete copies
+        version = None
+
+        for i, a in enumerate(self.archives):
+            if not a.exists(resource_id):
+                continue
+
+            if self.capacity[i] is not None:
+                if version is None:
+                    version = _version(self.archives[-1], resource_id) if self.archives[-1].exists(resource_id) else ''
+
+                if _version(a, resource_id) != version:
+                    self._demote(i, resource_id)
+                    continue
+
+            self._access(resource_id, i)
+
+            return MultiResource([ a.get(resource_id) ])
+
+        raise Exception('No resources found')
+
+    def exists(self, resource_id : str) -> bool:
+        return any(a.exists(resource_id) for a in self.archives)
+
+    def tiers(self) -> list:
+        return [ { 'capacity': c, 'used': sum(u.values()) if u is not None else None, 'resources': len(u) if u is not None else None } for c, u in zip(self.capacity, self.usage) ]
+
+    def refresh(self) -> int:
+        # drops copies that differ from the authoritative copy, returns the
+        # number dropped
+        n = 0
+
+        for i, usage in enumerate(self.usage):
+            for resource_id in list(usage or []):
+                if not self.archives[-1].exists(resource_id) or _version(self.archives[i], resource_id) != _version(self.archives[-1], resource_id):
+                    self._demote(i, resource_id)
+                    n += 1
+
+        return n
+
+    def start(self, interval : float = 60) -> Thread:
+        def loop():
+            while not self._stopped.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f'Refresh failed: {e}', file=stderr)
+
+        self._stopped.clear()
+        t = Thread(target=loop, daemon=True)
+        t.start()
+
+        return t
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        self.stop()
+
+        if self._pool:
+            self._pool.shutdown()
+
+    def _score(self, resource_id : str, now : float = None) -> float:
+        count, t = self.heat.get(resource_id, (0, 0))
+
+        return count * 0.5 ** (((now or monotonic()) - t) / self.half_life)
+
+    def _access(self, resource_id : str, tier : int):
+        now = monotonic()
+
+        with self._lock:
+            score = self._score(resource_id, now) + 1
+            self.heat[resource_id] = (score, now)
+
+            if len(self.heat) > 100000:
+                # forget the coldest half
+                for x in sorted(self.heat, key=lambda x: self._score(x, now))[:len(self.heat) // 2]:
+                    del self.heat[x]
+
+            # bounded, accesses while the queue is full are simply not acted
+            # on, with some slack as back to back accesses decay a little
+            if score < self.promote_after - 0.01 or resource_id in self._pending or len(self._pending) >= 2 * self.workers:
+                return
+
+            if not any(self.capacity[i] is not None for i in range(tier)):
+                return
+
+            self._pending.add(resource_id)
+
+        self._pool.submit(self._promote, resource_id, tier)
+
+    def _promote(self, resource_id : str, tier : int):
+        from tiniestarchive import FileResource
+
+        try:
+            with tagged(MAINTENANCE):
+                for i in range(tier):
+                    if self.capacity[i] is None:
+                        continue
+
+                    target = self.archives[i]
+                    target.ingest(FileResource.deserialize(self.archives[tier].serialize(resource_id), staging=target.staging))
+
+                    if self._fit(i, resource_id, _size(target, resource_id)):
+                        return
+        except Exception as e:
+            print(f'Promotion of {resource_id} failed: {e}', file=stderr)
+        finally:
+            with self._lock:
+                self._pending.discard(resource_id)
+
+    def _fit(self, tier : int, resource_id : str, size : int) -> bool:
+        # make room by demoting colder resources, or demote the new copy
+        with self._lock:
+            now = monotonic()
+            score, used = self._score(resource_id, now), sum(self.usage[tier].values())
+            victims = []
+
+            for x in sorted(self.usage[tier], key=lambda x: self._score(x, now)):
+                if used + size <= self.capacity[tier] or self._score(x, now) >= score:
+                    break
+
+                victims.append(x)
+                used -= self.usage[tier][x]
+
+            fits = used + size <= self.capacity[tier]
+
+            if fits:
+                self.usage[tier][resource_id] = size
+
+        for x in victims if fits else [ resource_id ]:
+            self._demote(tier, x)
+
+        return fits
+
+    def _demote(self, tier : int, resource_id : str):
+        with self._lock:
+            self.usage[tier].pop(resource_id, None)
+
+        self.archives[tier].delete(resource_id)
 
 
 class MultiResource(Resource):
@@ -15,21 +201,40 @@ class MultiResource(Resource):
         if not self.resources:
             raise Exception('No resources found')
 
-    def open(self, resource_id : str, path : str, mode='r'):
+    def open(self, path : str, mode='r'):
         for r in self.resources:
-            if path in r:
+            if r.exists(path):
                 return r.open(path, mode)
-    
-    def read(self, resource_id : str, path : str, mode : str = 'r'):
-        for r in reversed(self.resources):
-            if path in r:
+
+    def read(self, path : str, mode : str = 'r'):
+        for r in self.resources:
+            if r.exists(path):
                 return r.read(path, mode)
-            
-    def exists(self, resource_id : str):
+
+    def view(self, path : str) -> memoryview:
         for r in self.resources:
-            if r.exists(resource_id):
+            if r.exists(path):
+                return r.view(path)
+
+    def read_range(self, path : str, offset : int, length : int) -> bytes:
+        for r in self.resources:
+            if r.exists(path):
+                return r.read_range(path, offset, length)
+
+    def exists(self, path : str):
+        for r in self.resources:
+            if r.exists(path):
                 return True
 
         return False
-    
-    
+
+def _size(archive, resource_id : str) -> int:
+    # stored bytes of the live instances, from the manifest so that any
+    # archive can be measured
+    instances = archive.get(resource_id).manifest(fields=[ 'instances' ])['instances']
+
+    return sum(e.get('stored_size', e.get('size', 0)) for x in instances.values() for e in x['files'].values() if e.get('status', None) != DELETED)
+
+def _version(archive, resource_id : str) -> str:
+    # FileArchive has a cheap lookup
+    return archive.version(resource_id) if hasattr(archive, 'version') else archive.get(resource_id).config['version']
@@ -0,0 +1,74 @@
+from io import BytesIO
+from os import listdir, remove, rmdir, walk
+from pathlib import Path
+from shutil import copyfileobj
+
+# Small files can be appended to a few large pack files in the instance
+# directory instead of being stored as one file each under data/. The
+# instance.json entry of a packed file records the pack and the offset of
+# the stored bytes, i.e
+#
+#   { 'path': 'alto/0001.xml', 'size': 1234, ..., 'pack': 'packs/00000.pack', 'offset': 56789 }
+#
+# Packing is configured with a dict such as
+#
+#   { 'threshold': 65536, 'size': 1073741824 }
+#
+# where files up to threshold bytes are packed into packs of at most size
+# bytes.
+
+THRESHOLD = 64*1024
+PACK_SIZE = 1024*1024*1024
+
+def check(packing : dict):
+    if packing and not set(packing) <= { 'threshold', 'size' }:
+        raise Exception(f"Invalid packing: {packing}")
+
+def stored_size(entry : dict) -> int:
+    return entry.get('stored_size', entry['size'])
+
+def pack(instance_path : Path, files : dict, threshold : int = THRESHOLD, size : int = PACK_SIZE):
+    # appends small files to packs and updates their entries in place, the
+    # caller is responsible for saving the entries before calling cleanup
+    n, f, offset = 0, None, 0
+
+    try:
+        for path in sorted(files):
+            entry = files[path]
+
+            if entry.get('status', None) == 'deleted' or 'pack' in entry or stored_size(entry) > threshold:
+                continue
+
+            if f is None or offset + stored_size(entry) > size:
+                if f:
+                    f.close()
+
+                name = f'packs/{n:05}.pack'
+                instance_path.joinpath('packs').mkdir(exist_ok=True)
+                f, offset, n = instance_path.joinpath(name).open('wb'), 0, n + 1
+
+            with instance_path.joinpath('data', path).open('rb') as s:
+                copyfileobj(s, f)
+
+            entry.update({ 'pack': name, 'offset': offset })
+            offset += stored_size(entry)
+    finally:
+        if f:
+            f.close()
+
+def cleanup(instance_path : Path, files : dict):
+    # remove the loose copies of packed files, and directories left empty
+    for path, entry in files.items():
+        if 'pack' in entry and (p := instance_path.joinpath('data', path)).exists():
+            remove(p)
+
+    for root, dirs, filenames in walk(instance_path.joinpath('data'), topdown=False):
+        if Path(root) != instance_path.joinpath('data') and not listdir(root):
+            rmdir(root)
+
+def open_packed(pack_path : Path, entry : dict) -> BytesIO:
+    # packed files are small by definition, so just read the window
+    with open(pack_path, 'rb') as f:
+        f.seek(entry['offset'])
+
+        return BytesIO(f.read(stored_size(entry)))
@@ -0,0 +1,226 @@
+import cProfile
+import marshal
+import pstats
+import sys
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from io import StringIO
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic, time
+
+from uuid_utils import uuid7
+
+from .filearchive import FileArchive, FileInstance, FileResource
+
+# Opt-in profiling of slow requests and archive operations. Nothing is
+# wrapped or started until enable(), so a disabled profiler costs nothing.
+# Once enabled, an operation is captured
+#
+#   - with cProfile when asked for, e.g the X-Profile header in the app,
+#     plus a tracemalloc snapshot with memory=True (X-Profile: memory)
+#   - as stack samples, in collapsed (flame graph) format, when it takes
+#     longer than threshold seconds
+#
+# and kept in a ring of the last size captures. Operations within an
+# operation that is being captured are part of the outer capture.
+#
+# Captures are per thread, and cProfile only sees the thread that enabled
+# it, so requests are not captured as a whole: request() marks the
+# operations run for a request instead, which are then captured in the
+# thread that runs them. In an event loop that is the loop thread, which
+# nothing else runs on while an operation does, so concurrent requests
+# never end up in each other's captures.
+
+OPERATIONS = {
+    FileArchive: [ 'get', 'ingest', 'compact', 'find', 'changed', 'usage' ],
+    FileResource: [ '_reload', '_update', 'compact', 'manifest', 'deserialize', 'deserialize_many' ],
+    FileInstance: [ 'add', 'adopt', 'update', 'finalize', 'pack', 'deserialize' ]
+}
+
+_capturing = ContextVar('capturing', default=False)
+_request = ContextVar('request', default=None)
+
+class Profiler(object):
+    def __init__(self, size : int = 100, threshold : float = None, interval : float = 0.005):
+        self.captures = deque(maxlen=size)
+        self.threshold = threshold
+        self.interval = interval
+        self._active = {}
+        self._memory = 0
+        self._lock = Lock()
+        self._originals = []
+        self._stop = Event()
+
+    @contextmanager
+    def capture(self, name : str, profile : bool = False, memory : bool = False):
+        if _capturing.get():
+            yield
+            return
+
+        token = _capturing.set(True)
+        ident, samples, p = get_ident(), None, None
+
+        if profile:
+            try:
+                p = cProfile.Profile()
+                p.enable()
+            except ValueError:
+                # only one profiler at a time on newer pythons
+                p = None
+
+        if not p and self.threshold is not None:
+            samples = Counter()
+
+            with self._lock:
+                self._active.setdefault(ident, []).append(samples)
+
+        if memory:
+            with self._lock:
+                if self._memory == 0:
+                    tracemalloc.start()
+
+                self._memory += 1
+
+        start, t = time(), monotonic()
+
+        try:
+            yield
+        finally:
+            if p:
+                p.disable()
+
+            duration = monotonic() - t
+            _capturing.reset(token)
+            files = {}
+
+            if memory:
+                # allocations of all threads while any memory capture ran
+                snapshot = tracemalloc.take_snapshot()
+
+                with self._lock:
+                    self._memory -= 1
+
+                    if self._memory == 0:
+                        tracemalloc.stop()
+
+                files['memory.txt'] = ''.join(f'{x}\n' for x in snapshot.statistics('lineno')[:100]).encode('utf-8')
+
+            if samples is not None:
+                with self._lock:
+                    self._active[ident].remove(samples)
+
+                    if not self._active[ident]:
+                        del self._active[ident]
+
+                if duration >= self.threshold:
+                    files['stacks.txt'] = ''.join(f'{k} {v}\n' for k, v in samples.most_common()).encode('utf-8')
+
+            if p:
+                p.create_stats()
+                s = StringIO()
+                pstats.Stats(p, stream=s).sort_stats('cumulative').print_stats(100)
+                files['profile.prof'] = marshal.dumps(p.stats)
+                files['profile.txt'] = s.getvalue().encode('utf-8')
+
+            if files:
+                self.captures.append({ 'id': str(uuid7()), 'name': name, 'start': start, 'duration': duration, 'files': files })
+
+    @contextmanager
+    def request(self, name : str, profile : bool = True, memory : bool = False):
+        # operations run within are captured with these options, as
+        # '<name>: <operation>'
+        token = _request.set((name, profile, memory))
+
+        try:
+            yield
+        finally:
+            _request.reset(token)
+
+    def list(self) -> list:
+        return [ { **x, 'files': list(x['files']) } for x in self.captures ]
+
+    def get(self, capture_id : str) -> dict:
+        for x in self.captures:
+            if x['id'] == capture_id:
+                return x
+
+        raise Exception(f'Capture not found: {capture_id}')
+
+    def install(self, operations : dict = OPERATIONS):
+        for cls, names in operations.items():
+            for name in names:
+                original = cls.__dict__[name]
+                static = isinstance(original, staticmethod)
+                f = _wrap(self, f'{cls.__name__}.{name}', original.__func__ if static else original)
+
+                setattr(cls, name, staticmethod(f) if static else f)
+                self._originals.append((cls, name, original))
+
+        if self.threshold is not None:
+            self._stop.clear()
+            Thread(target=self._sample, daemon=True).start()
+
+    def uninstall(self):
+        self._stop.set()
+
+        while self._originals:
+            cls, name, original = self._originals.pop()
+            setattr(cls, name, original)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            if not self._active:
+                continue
+
+            frames = sys._current_frames()
+
+            with self._lock:
+                for ident, counters in self._active.items():
+                    if ident in frames:
+                        stack = _collapse(frames[ident])
+
+                        for c in counters:
+                            c[stack] += 1
+
+profiler = None
+
+def enable(size : int = 100, threshold : float = None, operations : dict = OPERATIONS) -> Profiler:
+    global profiler
+
+    disable()
+    profiler = Profiler(size=size, threshold=threshold)
+    profiler.install(operations)
+
+    return profiler
+
+def disable():
+    global profiler
+
+    if profiler:
+        profiler.uninstall()
+        profiler = None
+
+def _wrap(p : Profiler, name : str, f):
+    @wraps(f)
+    def g(*args, **kwargs):
+        if (request := _request.get()):
+            with p.capture(f'{request[0]}: {name}', profile=request[1], memory=request[2]):
+                return f(*args, **kwargs)
+
+        with p.capture(name):
+            return f(*args, **kwargs)
+
+    return g
+
+def _collapse(frame) -> str:
+    # root first, ';' separated
+    stack = []
+
+    while frame:
+        stack.append(f'{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_code.co_firstlineno})')
+        frame = frame.f_back
+
+    return ';'.join(reversed(stack))
@@ -53,7 +53,6 @@ class QueueIO(RawIOBase):
 
                     if wait < 0.001:
                         wait *= 2
-                        print(wait, file=stderr)
 
             if self.closed:
                 raise ValueError('I/O operation on closed stream')
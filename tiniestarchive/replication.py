@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from json import dumps, loads
+from pathlib import Path
+
+from . import DYNAMIC, OPEN, WRITE
+from .filearchive import FileArchive, FileInstance, FileResource
+from .scheduling import MAINTENANCE, tagged
+from .utils import write_atomic
+
+# Replicates a FileArchive or HttpArchive into a FileArchive by following
+# the event log of the source from a checkpoint. Resources that are new to
+# the target are transferred whole, otherwise only the instances the target
+# does not have. Instances are applied in order within each resource, while
+# several resources are replicated in parallel.
+#
+# The live instances of both are compared, finalized ones by id as they
+# never change, open ones (DYNAMIC) by version too. A copy that is not a
+# prefix of the source, e.g written to or compacted in place, is replaced
+# in a DYNAMIC target, while other targets only ever add instances, e.g a
+# compacted one. Resources deleted in the source are deleted in DYNAMIC
+# targets, other targets keep them.
+class Replicator(object):
+    def __init__(self, source, target : FileArchive, checkpoint : str = None, workers : int = 4):
+        self.source = source
+        self.target = target
+        self.checkpoint = Path(checkpoint) if checkpoint else target.root_dir.joinpath('replication.json')
+        self.workers = workers
+
+    def position(self) -> int:
+        return loads(self.checkpoint.read_text())['position'] if self.checkpoint.exists() else 0
+
+    def run(self, batch_size : int = 1000) -> int:
+        # replicate until the target has caught up with the source, returns
+        # the number of instances transferred
+        n = 0
+
+        while batch := list(islice(self.source.events(position=self.position()), batch_size)):
+            resource_ids = list(dict.fromkeys(e['ref'] for e in batch))
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                n += sum(pool.map(self.sync, resource_ids))
+
+            # only move the checkpoint once the whole batch is applied
+            write_atomic(self.checkpoint, dumps({ 'position': batch[-1]['position'] }))
+
+        return n
+
+    def sync(self, resource_id : str) -> int:
+        with tagged(MAINTENANCE):
+            return self._sync(resource_id)
+
+    def _sync(self, resource_id : str) -> int:
+        if not self.source.exists(resource_id):
+            if self.target.exists(resource_id) and self.target.operation_mode == DYNAMIC:
+                self.target.delete(resource_id)
+
+            return 0
+
+        source = self.source.get(resource_id)
+
+        if not self.target.exists(resource_id):
+            self.target.ingest(FileResource.deserialize(source.serialize(), staging=self.target.staging))
+
+            return len(source.config['instances'])
+
+        instances = _versions(source.manifest(fields=[ 'instances' ])['instances'])
+
+        with self.target.get(resource_id, mode=WRITE) as target:
+            existing = _versions(target.instances)
+            known = dict(existing)
+
+            if instances[:len(existing)] == existing:
+                missing = [ x for x, _ in instances[len(existing):] ]
+            elif self.target.operation_mode != DYNAMIC:
+                if any(x in known and known[x] != v for x, v in instances):
+                    raise Exception(f"Resource has changed in place: {resource_id}")
+
+                missing = [ x for x, _ in instances if x not in known ]
+            else:
+                missing = None
+
+            for instance_id in missing or []:
+                target.update(FileInstance.deserialize(source.serialize(instance_id=instance_id), staging=self.target.staging))
+
+        if missing is None:
+            # readers see no copy until the new one is ingested
+            self.target.delete(resource_id)
+            self.target.ingest(FileResource.deserialize(source.serialize(), staging=self.target.staging))
+
+            return len(instances)
+
+        return len(missing)
+
+def _versions(instances : dict) -> list:
+    # (id, version) of live instances, in order, the version of open ones only
+    return [ (k, v['version'] if v['status'] == OPEN else None) for k, v in instances.items() ]
@@ -0,0 +1,171 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Condition, Lock
+from time import monotonic, sleep
+
+# I/O classes, highest priority first:
+#
+#   foreground  - requests a user waits for, the default
+#   ingest      - new resources, i.e FileArchive.ingest and deserializing
+#   maintenance - background jobs, e.g compaction, replication, shards and
+#                 tier promotion
+#
+# Priority is given through limits per class, a token bucket for bandwidth
+# ('rate' bytes per second with bursts of 'burst' bytes) and a cap on the
+# number of concurrent operations ('concurrency'), e.g
+#
+#   configure({ 'maintenance': { 'rate': 50*1024*1024, 'concurrency': 1 } })
+#
+# Operations take the class of the code that runs them, tagged(), and
+# otherwise their own (see operation()). Byte counts are reported with
+# throttle() from the loops that move data, streams (serialize) are only
+# throttled and do not count as operations. Until configure() every call is
+# a no-op, and limits are per process, so process pools configure their
+# workers with a share of them, see limits().
+
+FOREGROUND = 'foreground'
+INGEST = 'ingest'
+MAINTENANCE = 'maintenance'
+
+CLASSES = [ FOREGROUND, INGEST, MAINTENANCE ]
+
+_tag = ContextVar('io_tag', default=None)
+_class = ContextVar('io_class', default=None)
+
+class TokenBucket(object):
+    # consuming more than is available goes into debt, which is waited off,
+    # so that any chunk size averages out to the rate
+    def __init__(self, rate : float, burst : float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.time = monotonic()
+        self._lock = Lock()
+
+    def consume(self, n : int):
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate) - n
+            self.time = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
+
+class IOScheduler(object):
+    def __init__(self, limits : dict):
+        if set(limits) - set(CLASSES):
+            raise Exception(f"Invalid I/O classes: {', '.join(set(limits) - set(CLASSES))}")
+
+        self.limits = limits
+        self.buckets = { k:TokenBucket(v['rate'], v.get('burst', None)) for k, v in limits.items() if v.get('rate', None) }
+        self.active = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self._condition = Condition()
+
+    @contextmanager
+    def operation(self, io_class : str):
+        concurrency = self.limits.get(io_class, {}).get('concurrency', None)
+
+        with self._condition:
+            while concurrency and self.active[io_class] >= concurrency:
+                self._condition.wait()
+
+            self.active[io_class] += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active[io_class] -= 1
+                self._condition.notify_all()
+
+    def throttle(self, io_class : str, n : int):
+        with self._condition:
+            self.bytes[io_class] += n
+
+        if io_class in self.buckets:
+            self.buckets[io_class].consume(n)
+
+    def stats(self) -> dict:
+        return { x:{ 'active': self.active[x], 'bytes': self.bytes[x] } for x in CLASSES }
+
+scheduler = None
+
+def configure(limits : dict) -> IOScheduler:
+    # None disables scheduling
+    global scheduler
+
+    scheduler = IOScheduler(limits) if limits else None
+
+    return scheduler
+
+def limits(processes : int = 1) -> dict:
+    # the configured limits split between processes, e.g as initializer
+    # arguments for the workers of a process pool
+    if not scheduler:
+        return None
+
+    return { k:{ **v, **{ x:v[x] / processes for x in [ 'rate', 'burst' ] if v.get(x, None) } } for k, v in scheduler.limits.items() }
+
+def disable():
+    global scheduler
+
+    scheduler = None
+
+def current() -> str:
+    return _class.get() or _tag.get() or FOREGROUND
+
+@contextmanager
+def tagged(io_class : str):
+    # everything run within is of io_class, unless already tagged
+    if io_class not in CLASSES:
+        raise Exception(f"Invalid I/O class: {io_class}")
+
+    token = _tag.set(_tag.get() or io_class)
+
+    try:
+        yield
+    finally:
+        _tag.reset(token)
+
+@contextmanager
+def operation(io_class : str = None):
+    # an operation of the tagged class, or else io_class, nested operations
+    # are part of the outer one
+    if not scheduler or _class.get():
+        yield
+        return
+
+    io_class = _tag.get() or io_class or FOREGROUND
+    token = _class.set(io_class)
+
+    try:
+        with scheduler.operation(io_class):
+            yield
+    finally:
+        _class.reset(token)
+
+def throttle(n : int, io_class : str = None):
+    # generators pass the class they were created with, as they may be
+    # consumed elsewhere
+    if scheduler:
+        scheduler.throttle(io_class or current(), n)
+
+def reader(f):
+    # throttles reads from a file object, e.g a tarball being extracted
+    return _Reader(f) if scheduler else f
+
+class _Reader(object):
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n : int = -1) -> bytes:
+        b = self.f.read(n)
+        throttle(len(b))
+
+        return b
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
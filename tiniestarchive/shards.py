@@ -0,0 +1,145 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from json import dumps, loads
+from os import walk
+from os.path import getsize, join
+from pathlib import Path
+import tarfile
+
+from .durability import sync_file
+from .filearchive import FileArchive, FileResource
+from .scheduling import MAINTENANCE, tagged, throttle
+
+# Bulk transfer of many resources as size-bounded tar shards, e.g to tape or
+# another site. The target directory gets
+#
+#   shard-00000.tar, shard-00001.tar, ...
+#   index.jsonl - { 'resource', 'shard', 'offset', 'size' } per resource
+#
+# Every shard holds whole resources laid out as in FileResource.serialize,
+# i.e '<resource_id>/resource.json', '<resource_id>/instances/...', starting
+# at the offset in the index. Shards are written in parallel, one writer per
+# shard, and only added to the index once complete, so an interrupted export
+# continues with the resources that are not yet in the index.
+
+SHARD_SIZE = 10*1024*1024*1024
+
+def export(archive : FileArchive, target : str, resource_ids : list = None, shard_size : int = SHARD_SIZE, workers : int = 4) -> int:
+    # returns the number of resources exported
+    target = Path(target)
+    target.mkdir(parents=True, exist_ok=True)
+
+    index = _index(target)
+    done = { x['resource'] for x in index }
+    shard_ids = count(max((int(x['shard'][6:-4]) + 1 for x in index), default=0))
+    n = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, target.joinpath('index.jsonl').open('a') as f:
+        pending = deque()
+
+        def collect():
+            nonlocal n
+
+            for entry in pending.popleft().result():
+                f.write(dumps(entry) + '\n')
+                n += 1
+
+            f.flush()
+
+        for shard in _plan(archive, (x for x in resource_ids or archive if x not in done), shard_size):
+            pending.append(pool.submit(_write, archive, target.joinpath(f'shard-{next(shard_ids):05}.tar'), shard))
+
+            if len(pending) >= 2 * workers:
+                collect()
+
+        while pending:
+            collect()
+
+    return n
+
+def ingest(archive : FileArchive, source : str, workers : int = 4) -> int:
+    # returns the number of resources ingested, resources that already
+    # exist in the archive are skipped
+    shards = list(dict.fromkeys(x['shard'] for x in _index(Path(source))))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(lambda x: _ingest(archive, Path(source).joinpath(x)), shards))
+
+def _index(path : Path) -> list:
+    if not path.joinpath('index.jsonl').exists():
+        return []
+
+    return [ loads(l) for l in path.joinpath('index.jsonl').read_text().splitlines() if l ]
+
+def _plan(archive : FileArchive, resource_ids : list, shard_size : int) -> list:
+    # consecutive resources up to shard_size bytes, larger resources get a
+    # shard of their own
+    shard, size = [], 0
+
+    for resource_id in resource_ids:
+        if not archive.exists(resource_id):
+            continue
+
+        s = _tar_size(archive._resolve(resource_id), resource_id)
+
+        if shard and size + s > shard_size:
+            yield shard
+            shard, size = [], 0
+
+        shard.append(resource_id)
+        size += s
+
+    if shard:
+        yield shard
+
+def _tar_size(path : Path, name : str) -> int:
+    # a header block per member, a GNU long name header for long names
+    # and file data padded to whole blocks
+    def header(member):
+        n = len(member.encode('utf-8'))
+
+        return 512 if n < 100 else 1024 + -(-(n + 1) // 512) * 512
+
+    size = 0
+    for root, _, files in walk(path):
+        prefix = join(name, Path(root).relative_to(path))
+        size += header(prefix) + sum(header(join(prefix, x)) + -(-getsize(join(root, x)) // 512) * 512 for x in files)
+
+    return size
+
+def _write(archive : FileArchive, path : Path, resource_ids : list) -> list:
+    tmp_path = path.parent.joinpath(f'{path.name}.tmp')
+    entries = []
+
+    with tarfile.open(tmp_path, 'w', format=tarfile.GNU_FORMAT) as t:
+        for resource_id in resource_ids:
+            resource = archive.get(resource_id)
+            offset = t.offset
+
+            # writers are held off so that the resource is consistent
+            with resource.lock:
+                t.add(resource.path, arcname=resource_id)
+
+            throttle(t.offset - offset, MAINTENANCE)
+
+            entries.append({ 'resource': resource_id, 'shard': path.name, 'offset': offset, 'size': t.offset - offset })
+
+    sync_file(tmp_path)
+    tmp_path.rename(path)
+
+    return entries
+
+def _ingest(archive : FileArchive, path : Path) -> int:
+    n = 0
+
+    with tagged(MAINTENANCE):
+        with path.open('rb') as f:
+            resources = FileResource.deserialize_many(f, staging=archive.staging)
+
+        for resource in resources:
+            if not archive.exists(resource.resource_id):
+                archive.ingest(resource)
+                n += 1
+
+    return n
@@ -0,0 +1,131 @@
+from hashlib import md5
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+from time import time
+from uuid import uuid4
+
+from .filelock import FileLock
+from .utils import write_atomic
+
+# A resumable upload of one (possibly very large) file. Chunks can be
+# written at any offset, in any order and in parallel, and the session
+# keeps track of which byte ranges it has. Sessions live in the staging
+# area of the archive as
+#
+#   _uploads/<session_id>/session.json
+#   _uploads/<session_id>/data
+#
+# and on commit the assembled file is renamed into a new transaction.
+# Sessions that have not been written to for MAX_AGE seconds are abandoned
+# and removed whenever a new session is created.
+
+MAX_AGE = 7*24*3600
+
+class UploadSession(object):
+    def __init__(self, path : Path):
+        self.path = Path(path)
+
+        if not self.path.joinpath('session.json').exists():
+            raise Exception(f"No such upload session: {self.path.name}")
+
+        self.lock = FileLock(self.path.joinpath('session.lock'))
+        self.config = loads(self.path.joinpath('session.json').read_text())
+        self.session_id = self.config['id']
+
+    def create(root : Path, resource_id : str, path : str, size : int, checksum : str = None):
+        if size < 0:
+            raise Exception(f"Invalid size: {size}")
+
+        UploadSession.expire(root)
+
+        session_id = str(uuid4())
+        session_path = Path(root).joinpath(session_id)
+        session_path.mkdir(parents=True)
+
+        # sparse file of the final size
+        with session_path.joinpath('data').open('wb') as f:
+            f.truncate(size)
+
+        write_atomic(
+            session_path.joinpath('session.json'),
+            dumps({ 'id': session_id, 'resource': resource_id, 'path': path, 'size': size, 'checksum': checksum, 'ranges': [] }, indent=4))
+
+        return UploadSession(session_path)
+
+    def expire(root : Path, max_age : float = MAX_AGE) -> int:
+        # session.json is rewritten on every chunk, so its age is the time
+        # since the session was last written to
+        n = 0
+        for session_path in Path(root).iterdir() if Path(root).exists() else []:
+            try:
+                p = session_path.joinpath('session.json')
+
+                if (p if p.exists() else session_path).stat().st_mtime < time() - max_age:
+                    rmtree(session_path)
+                    n += 1
+            except FileNotFoundError:
+                # e.g committed or expired by another process
+                pass
+
+        return n
+
+    def write(self, offset : int, data, checksum : str) -> list:
+        # data is a binary stream that is read into memory, so chunks are
+        # bounded by the caller, and only written once it is known to fit
+        # the file and match the checksum (md5)
+        if offset < 0 or offset > self.config['size']:
+            raise Exception(f"Invalid offset: {offset}")
+
+        chunk = data.read(self.config['size'] - offset + 1)
+
+        if offset + len(chunk) > self.config['size']:
+            raise Exception('Chunk exceeds file size')
+
+        if not checksum:
+            raise Exception('Missing checksum')
+
+        if checksum.lower().removeprefix('md5:') != md5(chunk).hexdigest():
+            raise Exception('Checksum mismatch')
+
+        with self.path.joinpath('data').open('r+b') as f:
+            f.seek(offset)
+            n = f.write(chunk)
+
+        with self.lock:
+            self.config = loads(self.path.joinpath('session.json').read_text())
+            self.config['ranges'] = _merge(self.config['ranges'] + [ [ offset, offset + n ] ])
+            write_atomic(self.path.joinpath('session.json'), dumps(self.config, indent=4))
+
+        return self.config['ranges']
+
+    def ranges(self) -> list:
+        return self.config['ranges']
+
+    def complete(self) -> bool:
+        return self.config['size'] == 0 or self.config['ranges'] == [ [ 0, self.config['size'] ] ]
+
+    def commit(self, resource):
+        if not self.complete():
+            raise Exception(f"Upload is incomplete: {self.config['ranges']}")
+
+        with resource.transaction() as t:
+            t.adopt(self.path.joinpath('data'), self.config['path'], checksum=self.config['checksum'])
+
+        self.abort()
+
+    def abort(self):
+        rmtree(self.path, ignore_errors=True)
+
+    def json(self) -> dict:
+        return dict(self.config)
+
+def _merge(ranges : list) -> list:
+    ret = []
+    for start, end in sorted(ranges):
+        if ret and start <= ret[-1][1]:
+            ret[-1][1] = max(ret[-1][1], end)
+        else:
+            ret.append([ start, end ])
+
+    return ret
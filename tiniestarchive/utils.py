@@ -1,23 +1,46 @@
 #import streaming_form_data
 #from streaming_form_data import StreamingFormDataParser
 #from streaming_form_data.targets import FileTarget, ValueTarget, SHA256Target
+from errno import EXDEV
 from itertools import count
-from os import makedirs
-from os.path import exists, join, dirname
+from mmap import mmap, ACCESS_READ
+from os import makedirs, remove, rename, fstat, fsync
+from os.path import exists, join, dirname, isdir
 import logging
 from urllib.parse import unquote
 from uuid import uuid4
 from tempfile import gettempdir
-from shutil import rmtree, move
+from shutil import rmtree, move, copyfileobj, copystat, copytree
+from .durability import sync_dir
+from .scheduling import throttle
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+
+# FICLONE from linux/fs.h
+FICLONE = 0x40049409
 
 def split_path(u):
     SPLITS = [ 0, 4, 6, 8, 10 ]
 
     return [ u.replace('-', '')[SPLITS[i]:SPLITS[i+1]] for i in range(0, len(SPLITS)-1) ] + [ u ]
 
-# TODO: more checks
-def safe_path(path):
-    return path.replace('..', '').replace('//', '/')
+def safe_path(path : str) -> str:
+    # normalized, relative and without parent references, i.e always within
+    # the directory it is joined to
+    parts = [ x for x in (path or '').split('/') if x not in [ '', '.' ] ]
+
+    if not parts or path.startswith('/') or '..' in parts or '\0' in path:
+        raise Exception(f"Invalid path: {path}")
+
+    return '/'.join(parts)
 
 
 async def save_to_tmp(instance_id, tmpdir, request):
@@ -60,3 +83,114 @@ def chunker(stream, chunk_size=100*1024):
     while b := stream.read(chunk_size):
         yield b
 
+
+def view(path, offset : int = 0, length : int = None) -> memoryview:
+    # read-only, page-cache backed, window into a file
+    with open(path, 'rb') as f:
+        size = fstat(f.fileno()).st_size
+
+        if size == 0:
+            return memoryview(b'')
+
+        m = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    length = size - offset if length is None else length
+
+    return memoryview(m)[offset:offset + length]
+
+def write_atomic(path, text : str, sync : bool = False):
+    # readers see either the old or the new file, never a partial one
+    tmp_path = f'{path}-tmp-{str(uuid4())}'
+
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+
+            if sync:
+                f.flush()
+                fsync(f.fileno())
+
+        rename(tmp_path, path)
+
+        if sync:
+            sync_dir(dirname(path) or '.')
+    except Exception as e:
+        if exists(tmp_path):
+            remove(tmp_path)
+
+        raise e
+
+def transfer(source, target):
+    # Move a file or directory. A rename is tried first and only when source
+    # and target are on different devices is the data copied, using reflinks
+    # or copy_file_range where possible. Either way the target appears
+    # atomically.
+    try:
+        rename(source, target)
+        return
+    except OSError as e:
+        if e.errno != EXDEV:
+            raise e
+
+    tmp_target = f'{target}-tmp-{str(uuid4())}'
+
+    try:
+        if isdir(source):
+            copytree(source, tmp_target, copy_function=copy_file)
+        else:
+            copy_file(source, tmp_target)
+
+        rename(tmp_target, target)
+    except Exception as e:
+        if isdir(tmp_target):
+            rmtree(tmp_target)
+        elif exists(tmp_target):
+            remove(tmp_target)
+
+        raise e
+
+    if isdir(source):
+        rmtree(source)
+    else:
+        remove(source)
+
+def copy_file(source, target):
+    with open(source, 'rb') as s, open(target, 'wb') as t:
+        throttle(fstat(s.fileno()).st_size)
+
+        if not _reflink(s, t) and not _copy_range(s, t):
+            s.seek(0)
+            t.seek(0)
+            t.truncate()
+            copyfileobj(s, t, 1024*1024)
+
+    copystat(source, target)
+
+    return target
+
+def _reflink(s, t) -> bool:
+    if not ioctl:
+        return False
+
+    try:
+        ioctl(t.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        return False
+
+def _copy_range(s, t) -> bool:
+    if not copy_file_range:
+        return False
+
+    try:
+        size, offset = fstat(s.fileno()).st_size, 0
+
+        while offset < size:
+            if (n := copy_file_range(s.fileno(), t.fileno(), size - offset)) == 0:
+                break
+
+            offset += n
+
+        return offset == size
+    except OSError:
+        return False